@@ -0,0 +1,101 @@
+"""文案替换微基准：对比逐条 str.replace 与编译后的单次扫描匹配器，随规则数量增长每条消息的耗时
+
+用法:
+    python benchmarks/bench_text_replace.py
+    python benchmarks/bench_text_replace.py --rules 1,10,100,1000 --messages 2000
+"""
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_main():
+    """用临时配置导入 main.py（不连接 Telegram，不写入项目目录）"""
+    tmp = tempfile.mkdtemp(prefix='tguserbot_bench_')
+    config_path = os.path.join(tmp, 'config.json')
+    with open(config_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'accounts': [{'api_id': 1, 'api_hash': 'bench', 'name': 'bench'}],
+            'target_bot_username': 'bench_bot',
+            'log_dir': os.path.join(tmp, 'logs'),
+            'log_level': 'WARNING',
+            'task_journal': '',
+            'media_spool_dir': os.path.join(tmp, 'spool'),
+        }, f)
+    os.environ['TGUSERBOT_CONFIG'] = config_path
+    sys.path.insert(0, ROOT)
+    import main
+    return main
+
+
+def random_word(rng: random.Random) -> str:
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 8)))
+
+
+def make_corpus(rng: random.Random, rules, count: int):
+    words = [f for f, _, _ in rules]
+    messages = []
+    for _ in range(count):
+        parts = []
+        for _ in range(40):
+            parts.append(rng.choice(words) if rng.random() < 0.1 else random_word(rng))
+        messages.append(' '.join(parts))
+    return messages
+
+
+def naive_apply(text: str, rules) -> str:
+    for from_str, to_str, _ in rules:
+        text = text.replace(from_str, to_str)
+    return text
+
+
+def per_message_us(fn, messages, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in messages:
+            fn(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(messages) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rules', default='1,10,100,1000', help='规则数量列表，逗号分隔')
+    parser.add_argument('--messages', type=int, default=2000, help='每轮消息数')
+    parser.add_argument('--repeat', type=int, default=5, help='重复次数（取最快一次）')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    bot = load_main()
+    rng = random.Random(args.seed)
+    print(f"{'规则数':>8} {'逐条替换 us/条':>16} {'编译匹配 us/条':>16} {'编译耗时 ms':>12}")
+    for n in (int(x) for x in args.rules.split(',')):
+        rules = []
+        seen = set()
+        while len(rules) < n:
+            word = random_word(rng)
+            if word not in seen:
+                seen.add(word)
+                rules.append((word, word.upper(), 'literal'))
+        messages = make_corpus(rng, rules, args.messages)
+
+        start = time.perf_counter()
+        replacer = bot.compile_replacements(rules)
+        compile_ms = (time.perf_counter() - start) * 1000
+
+        naive = per_message_us(lambda t: naive_apply(t, rules), messages, args.repeat)
+        compiled = per_message_us(replacer.apply, messages, args.repeat)
+        print(f"{n:>8} {naive:>16.2f} {compiled:>16.2f} {compile_ms:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,343 @@
+"""离线压测：用进程内的假 TelegramClient 与合成 NewMessage 事件端到端驱动 handler → 去重 → 发送调度
+
+同一条消息会按 --fanout 送达多个监听账号（模拟多个账号在同一群组中），可配置消息速率、媒体大小与相册突发；
+--media-reuse 模拟目标把同一个文件发到多个群组。
+输出吞吐（条/秒）、收到→发送延迟分位数、峰值内存以及重复发送/漏发数量；--max-duplicates 等参数可作为 CI 门槛。
+
+用法:
+    python benchmarks/loadtest.py
+    python benchmarks/loadtest.py --accounts 5 --messages 5000 --rate 500 --media-ratio 0.3 --album-ratio 0.05
+    python benchmarks/loadtest.py --json --max-duplicates 0 --max-p99-ms 500
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from bench_text_replace import load_main
+
+SENDER_ID = 424242
+
+
+class FakeTelegramClient:
+    """TelegramClient 的进程内替身：只实现 handler 与发送路径用到的方法，用 sleep 模拟网络耗时"""
+
+    def __init__(self, name: str, run: 'LoadRun'):
+        self.name = name
+        self.run = run
+
+    async def download_media(self, message, file):
+        size = message.file.size
+        self.run.downloads += 1
+        await asyncio.sleep(self.run.args.download_latency + size / self.run.args.bandwidth)
+        data = b'\0' * size
+        if file is bytes:
+            return data
+        with open(file, 'wb') as f:
+            f.write(data)
+        return file
+
+    async def upload_file(self, data, file_name=None):
+        from telethon.tl.types import InputFile
+        size = len(data) if isinstance(data, (bytes, bytearray)) else os.path.getsize(data)
+        await asyncio.sleep(self.run.args.send_latency + size / self.run.args.bandwidth)
+        return InputFile(id=random.getrandbits(62), parts=1, name=file_name or 'file', md5_checksum='')
+
+    async def send_message(self, chat_id, text):
+        await asyncio.sleep(self.run.args.send_latency)
+        self.run.record_send(self.name, chat_id, text)
+
+    async def send_file(self, chat_id, file, caption=None, **kwargs):
+        await asyncio.sleep(self.run.args.send_latency)
+        if isinstance(caption, list):
+            caption = next((c for c in caption if c), '')
+        self.run.record_send(self.name, chat_id, caption or '')
+
+
+class LoadRun:
+    """一次压测：生成事件、记录每条源消息的生成时间与实际发送次数"""
+
+    def __init__(self, bot, args):
+        self.bot = bot
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.generated_at = {}
+        self.send_counts = Counter()
+        self.latencies = []
+        self.first_event = None
+        self.last_send = None
+        self.events = 0
+        self.next_message_id = 1000
+        self.next_media_id = 1
+        self.downloads = 0
+
+    def record_send(self, account: str, chat_id: int, text: str) -> None:
+        now = time.monotonic()
+        self.last_send = now
+        seq = int(text.split(' ', 1)[0][1:]) if text.startswith('m') else -1
+        self.send_counts[seq] += 1
+        if self.send_counts[seq] == 1 and seq in self.generated_at:
+            self.latencies.append(now - self.generated_at[seq])
+
+    def media_id(self) -> int:
+        """新文件，或按 --media-reuse 的比例复用已发过的文件"""
+        if self.next_media_id > 1 and self.rng.random() < self.args.media_reuse:
+            return self.rng.randrange(max(1, self.next_media_id - 20), self.next_media_id)
+        self.next_media_id += 1
+        return self.next_media_id - 1
+
+    def make_message(self, seq: int, message_id: int, grouped_id=None, media_id=None, text=None):
+        from telethon.tl.types import MessageMediaPhoto, Photo
+        media = None
+        file = None
+        if media_id is not None:
+            media = MessageMediaPhoto(photo=Photo(id=media_id, access_hash=0, file_reference=b'', date=None, sizes=[], dc_id=1))
+            file = SimpleNamespace(size=self.args.media_size)
+        return SimpleNamespace(
+            out=False,
+            id=message_id,
+            sender_id=SENDER_ID,
+            grouped_id=grouped_id,
+            date=datetime.now(timezone.utc),
+            message=text if text is not None else f'm{seq} ' + 'x' * self.args.text_size,
+            media=media,
+            file=file,
+        )
+
+    def make_event(self, client, chat: int, message):
+        from telethon.tl.types import PeerChannel
+        from telethon.utils import get_peer_id
+        peer = PeerChannel(chat)
+        sender = SimpleNamespace(id=SENDER_ID, username='bench_bot', bot=True)
+
+        async def get_sender():
+            return sender
+
+        return SimpleNamespace(message=message, peer_id=peer, chat_id=get_peer_id(peer), client=client, get_sender=get_sender)
+
+    def source_messages(self, seq: int):
+        """一条源消息：普通消息，或 --album-size 个部分组成的相册（只有第一部分带文字）"""
+        if self.rng.random() < self.args.album_ratio:
+            grouped_id = self.rng.getrandbits(62)
+            parts = []
+            for part in range(self.args.album_size):
+                parts.append((grouped_id, self.media_id(), None if part == 0 else ''))
+            return parts
+        return [(None, self.media_id() if self.rng.random() < self.args.media_ratio else None, None)]
+
+    async def deliver(self, seq: int, chat: int, clients) -> None:
+        """把同一条源消息分发给 fanout 个监听账号，各账号之间带随机到达偏移"""
+        receivers = self.rng.sample(clients, min(self.args.fanout, len(clients)))
+        parts = self.source_messages(seq)
+        base_ids = []
+        for _ in parts:
+            base_ids.append(self.next_message_id)
+            self.next_message_id += 1
+        tasks = []
+        for offset, client in enumerate(receivers):
+            delay = self.rng.uniform(0, self.args.skew)
+            # 普通群组中各账号看到的 message.id 不同，依靠内容去重键识别同一消息
+            id_shift = offset * 10_000_000 if self.args.distinct_ids else 0
+            messages = [
+                self.make_message(seq, base_id + id_shift, grouped_id, media_id, text)
+                for base_id, (grouped_id, media_id, text) in zip(base_ids, parts)
+            ]
+            tasks.append(asyncio.create_task(self.dispatch(client, chat, messages, delay)))
+        await asyncio.gather(*tasks)
+
+    async def dispatch(self, client, chat: int, messages, delay: float) -> None:
+        if delay:
+            await asyncio.sleep(delay)
+        # 同一账号按到达顺序依次处理相册各部分；不同消息、不同账号之间并发
+        for message in messages:
+            self.events += 1
+            await self.bot.handler(self.make_event(client, chat, message))
+
+    async def wait_drained(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.bot.album_collector.window + 0.05)
+            await self.bot.send_scheduler.join()
+            if not self.bot.album_collector.pending() and self.bot.send_scheduler.empty():
+                return True
+        return False
+
+
+def setup_runtime(bot, run: LoadRun, args):
+    """按 main() 的方式初始化运行时全局变量，客户端换成假客户端"""
+    bot.clients = [FakeTelegramClient(f'acc{i}', run) for i in range(args.accounts)]
+    bot.active_accounts = [{'name': f'acc{i}', 'api_id': i} for i in range(args.accounts)]
+    bot.client_indices = {c: i for i, c in enumerate(bot.clients)}
+    bot.send_interval = args.send_interval
+    bot.send_jitter = 0.0
+    bot.send_scheduler = bot.SendScheduler(bot.send_queue_max_size, bot.send_queue_full_timeout, bot.send_queue_max_age)
+    bot.rate_limiter = bot.RateLimiter(args.rate_limit, max(1.0, args.rate_limit / 60), 0)
+    bot.upload_cache = bot.UploadCache(bot.upload_cache_ttl, bot.upload_cache_max_entries)
+    bot.media_budget = bot.MediaMemoryBudget(bot.media_memory_budget)
+    bot.album_collector = bot.AlbumCollector(args.album_window)
+    bot.message_dedup_lock = asyncio.Lock()
+    bot.seen_by_id = bot.DedupStore('seen_by_id')
+    bot.claimed_messages = bot.DedupStore('claimed')
+    bot.sent_messages = bot.DedupStore('sent')
+    bot.our_user_ids = set()
+    bot.chat_client_index = bot.ChatCounters(int, bot.distribution_max_chats)
+    bot.chat_client_usage = bot.ChatCounters(lambda: bot.defaultdict(int), bot.distribution_max_chats)
+    bot.account_load = bot.AccountLoad(args.accounts, bot.failure_penalty)
+    bot.chat_progress = bot.ChatProgress()
+    bot.account_health = bot.AccountHealth(args.accounts)
+    bot.task_journal = None
+    bot.trace_writer = None
+    bot.start_time = None
+    bot.metrics = bot.Metrics()
+    target = bot.targets[0]
+    target.user_id = SENDER_ID
+    target.is_bot = True
+    target.distribution_strategy = args.strategy
+    bot.targets_by_id = {SENDER_ID: target}
+    os.makedirs(bot.media_spool_dir, exist_ok=True)
+    bot.media_cache = bot.MediaCache(bot.media_cache_memory_bytes, bot.media_cache_disk_bytes, os.path.join(bot.media_spool_dir, 'cache'))
+    bot.media_cache.open()
+    bot.download_pool = bot.DownloadPool(args.download_workers)
+    bot.download_pool.start()
+    for index in range(args.accounts):
+        bot.send_scheduler.start_worker(index)
+
+
+def percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+async def run_load(bot, args) -> dict:
+    run = LoadRun(bot, args)
+    setup_runtime(bot, run, args)
+    interval = 1.0 / args.rate if args.rate > 0 else 0.0
+    chats = [1_000_000 + i for i in range(args.chats)]
+    deliveries = []
+    started = time.monotonic()
+    run.first_event = started
+    for seq in range(args.messages):
+        scheduled = started + seq * interval
+        now = time.monotonic()
+        if scheduled > now:
+            await asyncio.sleep(scheduled - now)
+        run.generated_at[seq] = time.monotonic()
+        deliveries.append(asyncio.create_task(run.deliver(seq, run.rng.choice(chats), bot.clients)))
+    await asyncio.gather(*deliveries)
+    handlers_done = time.monotonic()
+    drained = await run.wait_drained(args.drain_timeout)
+    await bot.send_scheduler.stop()
+    await bot.download_pool.stop()
+    media_cache = bot.media_cache.stats()
+    bot.media_cache.close()
+    finished = run.last_send or time.monotonic()
+
+    delivered = sum(1 for seq in range(args.messages) if run.send_counts[seq])
+    duplicates = sum(count - 1 for count in run.send_counts.values() if count > 1)
+    dedup = {
+        f"{dict(labels)['stage']}_{dict(labels)['result']}": int(value)
+        for (name, labels), value in bot.metrics.counters.items()
+        if name == 'tguserbot_dedup_checks_total'
+    }
+    return {
+        'messages': args.messages,
+        'events': run.events,
+        'delivered': delivered,
+        'missing': args.messages - delivered,
+        'duplicates': duplicates,
+        'drained': drained,
+        'handler_events_per_sec': run.events / max(handlers_done - started, 1e-9),
+        'messages_per_sec': delivered / max(finished - started, 1e-9),
+        'latency_ms': {
+            'p50': percentile(run.latencies, 50) * 1000,
+            'p90': percentile(run.latencies, 90) * 1000,
+            'p99': percentile(run.latencies, 99) * 1000,
+            'max': max(run.latencies, default=0.0) * 1000,
+        },
+        'dedup_checks': dedup,
+        'downloads': run.downloads,
+        'media_cache': {key: media_cache[key] for key in ('hits', 'misses', 'merged', 'evicted')},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--accounts', type=int, default=3, help='监听/发送账号数')
+    parser.add_argument('--fanout', type=int, default=None, help='每条消息送达的账号数（默认全部账号）')
+    parser.add_argument('--messages', type=int, default=1000, help='源消息数')
+    parser.add_argument('--rate', type=float, default=200, help='源消息速率（条/秒），0 表示尽快')
+    parser.add_argument('--chats', type=int, default=20, help='群组数')
+    parser.add_argument('--skew', type=float, default=0.05, help='同一消息在各账号间的最大到达偏移（秒）')
+    parser.add_argument('--distinct-ids', action='store_true', help='各账号看到不同的 message.id（普通群组）')
+    parser.add_argument('--text-size', type=int, default=80, help='消息文字长度')
+    parser.add_argument('--media-ratio', type=float, default=0.2, help='带媒体的消息比例')
+    parser.add_argument('--media-size', type=int, default=200_000, help='媒体大小（字节）')
+    parser.add_argument('--media-reuse', type=float, default=0.0, help='媒体复用最近 20 个文件之一的比例（同一文件发往多个群组）')
+    parser.add_argument('--album-ratio', type=float, default=0.02, help='相册消息比例')
+    parser.add_argument('--album-size', type=int, default=4, help='每个相册的部分数')
+    parser.add_argument('--album-window', type=float, default=0.2, help='相册收集窗口（秒）')
+    parser.add_argument('--strategy', default='round_robin', choices=['round_robin', 'random', 'least_loaded'], help='发送账号分配策略')
+    parser.add_argument('--send-interval', type=float, default=0.0, help='每账号发送间隔（秒）')
+    parser.add_argument('--rate-limit', type=float, default=6000, help='每账号每群组每分钟发送预算')
+    parser.add_argument('--send-latency', type=float, default=0.01, help='模拟发送/上传的网络耗时（秒）')
+    parser.add_argument('--download-latency', type=float, default=0.01, help='模拟下载的固定耗时（秒）')
+    parser.add_argument('--download-workers', type=int, default=4, help='后台下载 worker 数')
+    parser.add_argument('--bandwidth', type=float, default=50e6, help='模拟上传/下载带宽（字节/秒）')
+    parser.add_argument('--drain-timeout', type=float, default=60, help='等待队列清空的最长时间（秒）')
+    parser.add_argument('--tracemalloc', action='store_true', help='用 tracemalloc 统计 Python 堆峰值（会降低吞吐）')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='以 JSON 输出结果')
+    parser.add_argument('--max-duplicates', type=int, default=None, help='重复发送超过该值时以非零状态退出')
+    parser.add_argument('--max-missing', type=int, default=None, help='漏发超过该值时以非零状态退出')
+    parser.add_argument('--max-p99-ms', type=float, default=None, help='p99 延迟超过该值（毫秒）时以非零状态退出')
+    args = parser.parse_args()
+    args.fanout = args.accounts if args.fanout is None else args.fanout
+
+    bot = load_main()
+    if args.tracemalloc:
+        tracemalloc.start()
+    result = asyncio.run(run_load(bot, args))
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if args.tracemalloc:
+        result['tracemalloc_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        lat = result['latency_ms']
+        print(f"源消息 {result['messages']} 条，handler 事件 {result['events']} 个（{args.accounts} 个账号，fanout {args.fanout}）")
+        print(f"handler 吞吐: {result['handler_events_per_sec']:.0f} 事件/秒；端到端发送: {result['messages_per_sec']:.0f} 条/秒")
+        print(f"收到→发送延迟 ms: p50 {lat['p50']:.1f}  p90 {lat['p90']:.1f}  p99 {lat['p99']:.1f}  max {lat['max']:.1f}")
+        print(f"已发送 {result['delivered']}，漏发 {result['missing']}，重复发送 {result['duplicates']}，队列已清空: {result['drained']}")
+        print(f"去重检查: {result['dedup_checks']}")
+        print(f"媒体下载 {result['downloads']} 次，媒体缓存: {result['media_cache']}")
+        memory = f"峰值 RSS: {result['peak_rss_mb']:.1f} MB"
+        if 'tracemalloc_peak_mb' in result:
+            memory += f"，Python 堆峰值: {result['tracemalloc_peak_mb']:.1f} MB"
+        print(memory)
+
+    failed = []
+    if args.max_duplicates is not None and result['duplicates'] > args.max_duplicates:
+        failed.append(f"重复发送 {result['duplicates']} > {args.max_duplicates}")
+    if args.max_missing is not None and result['missing'] > args.max_missing:
+        failed.append(f"漏发 {result['missing']} > {args.max_missing}")
+    if args.max_p99_ms is not None and result['latency_ms']['p99'] > args.max_p99_ms:
+        failed.append(f"p99 {result['latency_ms']['p99']:.1f}ms > {args.max_p99_ms}ms")
+    if failed:
+        print("❌ " + "；".join(failed), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
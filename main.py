@@ -2,15 +2,35 @@ import logging
 import sys
 import os
 import json
+import re
 import asyncio
 import random
-import io
-from datetime import datetime, timezone
-from collections import defaultdict
-from typing import List, Dict, Set, Tuple, Optional
+import time
+import hashlib
+import uuid
+import bisect
+import heapq
+import sqlite3
+import shutil
+import queue
+import atexit
+import signal
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from datetime import datetime, timezone, timedelta
+from collections import defaultdict, OrderedDict, deque
+from typing import List, Dict, Set, FrozenSet, Tuple, Optional, Union
 from telethon import TelegramClient, events
-from telethon.errors import SessionPasswordNeededError
+from telethon.errors import (
+    SessionPasswordNeededError,
+    FloodWaitError,
+    SlowModeWaitError,
+    FilePartMissingError,
+    FilePart0MissingError,
+    FilePartsInvalidError,
+    MediaEmptyError,
+)
 from telethon.utils import get_peer_id
+from telethon.tl.functions.updates import GetStateRequest
 from telethon.tl.types import (
     MessageMediaPhoto,
     MessageMediaDocument,
@@ -20,83 +40,385 @@ from telethon.tl.types import (
 )
 
 # 加载配置文件
-def load_config():
-    """加载配置文件"""
-    config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
-    
+def config_file_path() -> str:
+    """配置文件路径（可用环境变量 TGUSERBOT_CONFIG 指定其他路径）"""
+    return os.environ.get('TGUSERBOT_CONFIG') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+
+def read_config() -> dict:
+    """读取并校验配置文件，配置有误时抛出 ValueError（启动时与热加载共用）"""
+    config_path = config_file_path()
     if not os.path.exists(config_path):
-        print(f"错误: 配置文件不存在: {config_path}")
-        print("请复制 config.json.example 为 config.json 并填写配置信息")
-        sys.exit(1)
+        raise ValueError(f"配置文件不存在: {config_path}")
     
     try:
         with open(config_path, 'r', encoding='utf-8') as f:
             config = json.load(f)
-        
-        if 'accounts' not in config:
-            if 'api_id' in config and 'api_hash' in config:
-                config['accounts'] = [{
-                    'api_id': config['api_id'],
-                    'api_hash': config['api_hash'],
-                    'name': f"account_{config['api_id']}"
-                }]
-            else:
-                print("错误: 配置文件缺少必需的配置项: accounts 或 api_id/api_hash")
-                sys.exit(1)
-        
-        if 'target_bot_username' not in config:
-            print("错误: 配置文件缺少必需的配置项: target_bot_username")
-            sys.exit(1)
-        
-        for i, account in enumerate(config['accounts']):
-            if 'api_id' not in account or 'api_hash' not in account:
-                print(f"错误: 账户 {i+1} 缺少 api_id 或 api_hash")
-                sys.exit(1)
-            if 'name' not in account:
-                account['name'] = f"account_{account['api_id']}"
-        
-        return config
     except json.JSONDecodeError as e:
-        print(f"错误: 配置文件格式错误: {str(e)}")
-        sys.exit(1)
-    except Exception as e:
-        print(f"错误: 加载配置文件失败: {str(e)}")
+        raise ValueError(f"配置文件格式错误: {str(e)}")
+    except OSError as e:
+        raise ValueError(f"加载配置文件失败: {str(e)}")
+    
+    if 'accounts' not in config:
+        if 'api_id' in config and 'api_hash' in config:
+            config['accounts'] = [{
+                'api_id': config['api_id'],
+                'api_hash': config['api_hash'],
+                'name': f"account_{config['api_id']}"
+            }]
+        else:
+            raise ValueError("配置文件缺少必需的配置项: accounts 或 api_id/api_hash")
+    
+    if 'target_bot_username' not in config and not config.get('targets'):
+        raise ValueError("配置文件缺少必需的配置项: targets 或 target_bot_username")
+    
+    for i, target in enumerate(config.get('targets') or []):
+        if not target.get('username'):
+            raise ValueError(f"目标 {i+1} 缺少 username")
+    
+    for i, account in enumerate(config['accounts']):
+        if 'api_id' not in account or 'api_hash' not in account:
+            raise ValueError(f"账户 {i+1} 缺少 api_id 或 api_hash")
+        if 'name' not in account:
+            account['name'] = f"account_{account['api_id']}"
+    
+    return config
+
+def load_config():
+    """加载配置文件，有误时打印原因并退出"""
+    try:
+        return read_config()
+    except ValueError as e:
+        print(f"错误: {str(e)}")
+        if not os.path.exists(config_file_path()):
+            print("请复制 config.json.example 为 config.json 并填写配置信息")
         sys.exit(1)
 
 # 加载配置
 config = load_config()
 accounts = config['accounts']
-target_bot_username = config['target_bot_username']
-distribution_strategy = config.get('distribution_strategy', 'round_robin')
-if distribution_strategy == 'round':
-    distribution_strategy = 'round_robin'
+
+def normalize_strategy(strategy: str) -> str:
+    return 'round_robin' if strategy == 'round' else strategy
+
+# 全局默认分配策略（round_robin / random / least_loaded），targets 中未单独配置的目标使用它
+distribution_strategy = normalize_strategy(config.get('distribution_strategy', 'round_robin'))
+# 分配计数最多保留的群组数（按最近使用淘汰）；least_loaded 策略中一次近期失败折算的负载秒数
+distribution_max_chats = int(config.get('distribution_max_chats', 10000))
+failure_penalty = float(config.get('failure_penalty', 5.0))
 
 # 消息发送配置（防止风控）
 send_interval = config.get('send_interval', 2.0)
 send_jitter = config.get('send_jitter', 1.0)
 
-def parse_text_replacements(cfg: dict) -> List[Tuple[str, str]]:
-    """解析文案替换规则，支持 text_replacements 列表或 text_prefix_replace 字典"""
+# 发送队列容量：最多排队的任务数（0 为不限）；队列满时 handler 最多等待的秒数，超时则丢弃新任务（0 为立即丢弃）
+send_queue_max_size = max(0, int(config.get('send_queue_max_size', 1000)))
+send_queue_full_timeout = float(config.get('send_queue_full_timeout', 10))
+# 任务入队后超过该秒数仍未发送则丢弃（0 为不限），避免故障恢复后逐条补发早已过时的消息
+send_queue_max_age = float(config.get('send_queue_max_age', 0))
+# 发送优先级（仅在不同群组之间生效）：文字先于媒体，总大小达到该字节数的媒体最后；等待超过 priority_aging 秒的任务视为最高优先级
+priority_large_media_bytes = int(config.get('priority_large_media_bytes', 20 * 1024 * 1024))
+priority_aging = float(config.get('priority_aging', 30))
+
+# 自适应限速：每个 (账号, 群组) 每分钟的发送预算与突发量；FloodWait 冷却额外留出的余量
+rate_limit_per_minute = float(config.get('rate_limit_per_minute', 20))
+rate_limit_burst = float(config.get('rate_limit_burst', 3))
+flood_wait_padding = float(config.get('flood_wait_padding', 1.0))
+# 冷却超过该秒数时放弃发送而不是一直等待
+max_flood_wait = float(config.get('max_flood_wait', 600))
+# Telethon 内部自动等待的 FloodWait 上限，超过的交给限速器处理
+flood_sleep_threshold = int(config.get('flood_sleep_threshold', 5))
+
+# 上传句柄缓存：Telegram 的句柄有效期不足一天
+upload_cache_ttl = float(config.get('upload_cache_ttl', 6 * 3600))
+upload_cache_max_entries = int(config.get('upload_cache_max_entries', 500))
+
+# 媒体落盘：超过阈值的文件直接写入 spool 目录；排队媒体的内存总预算（字节）
+media_spool_threshold = int(config.get('media_spool_threshold', 5 * 1024 * 1024))
+# 并发下载媒体的 worker 数（任务先入队，媒体在后台下载）
+download_workers = max(1, int(config.get('download_workers', 4)))
+media_memory_budget = int(config.get('media_memory_budget', 100 * 1024 * 1024))
+# 下载侧媒体缓存：同一源文件（文件 ID + 大小）发往多个群组时只下载一次；内存与磁盘（spool 目录下 cache/）的字节上限，0 为不使用该层
+media_cache_memory_bytes = int(config.get('media_cache_memory_bytes', 50 * 1024 * 1024))
+media_cache_disk_bytes = int(config.get('media_cache_disk_bytes', 500 * 1024 * 1024))
+media_spool_dir_config = config.get('media_spool_dir', 'media_spool')
+if os.path.isabs(media_spool_dir_config):
+    media_spool_dir = media_spool_dir_config
+else:
+    media_spool_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), media_spool_dir_config)
+
+# 目标用户 ID 定期重新解析的间隔（秒）；可选的群组白名单（群组 ID 列表）
+target_refresh_interval = float(config.get('target_refresh_interval', 3600))
+chat_allowlist: Optional[FrozenSet[int]] = frozenset(config['chat_allowlist']) if config.get('chat_allowlist') else None
+
+# 任务日志（SQLite）：留空则不持久化；批量提交间隔（秒）
+task_journal_config = config.get('task_journal', 'tasks.db')
+if not task_journal_config:
+    task_journal_path = None
+elif os.path.isabs(task_journal_config):
+    task_journal_path = task_journal_config
+else:
+    task_journal_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), task_journal_config)
+journal_flush_interval = float(config.get('journal_flush_interval', 0.2))
+
+# 本地指标端点（Prometheus 文本格式），端口为 0 时不启用
+metrics_host = config.get('metrics_host', '127.0.0.1')
+metrics_port = int(config.get('metrics_port', 0))
+
+# 相册收集窗口：最后一个部分到达后等待的秒数
+album_collect_window = float(config.get('album_collect_window', 1.0))
+
+# 断线/重启补抓：记录各账号在各群组已处理到的最大目标消息 ID，启动或重连后用 min_id 批量拉取期间漏掉的消息
+catch_up_enabled = bool(config.get('catch_up', True))
+# 只补抓该秒数以内的消息；每个 (群组, 目标) 单次最多拉取的条数；同时进行的拉取请求数
+catch_up_max_age = float(config.get('catch_up_max_age', 3600))
+catch_up_limit = max(1, int(config.get('catch_up_limit', 50)))
+catch_up_concurrency = max(1, int(config.get('catch_up_concurrency', 3)))
+# 检查账号连接状态（判断是否发生过重连）的间隔（秒）
+catch_up_check_interval = float(config.get('catch_up_check_interval', 5))
+
+# 启动：同时连接的账号数、单个账号连接与验证登录状态的超时（秒）
+startup_concurrency = max(1, int(config.get('startup_concurrency', 5)))
+connect_timeout = float(config.get('connect_timeout', 30))
+# 无人值守模式：需要交互登录的账号直接跳过；未配置时在没有终端（stdin 非 tty）时自动启用
+headless = bool(config['headless']) if config.get('headless') is not None else not sys.stdin.isatty()
+# 账号身份（get_me）与目标实体的本地缓存，重启时跳过重复查询；留空则不缓存
+startup_cache_config = config.get('startup_cache', 'startup_cache.json')
+if not startup_cache_config:
+    startup_cache_path = None
+elif os.path.isabs(startup_cache_config):
+    startup_cache_path = startup_cache_config
+else:
+    startup_cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), startup_cache_config)
+startup_cache_ttl = float(config.get('startup_cache_ttl', 7 * 86400))
+
+# 账号连接监督：检查间隔；超过 health_update_timeout 秒未收到任何更新时发起一次 ping（updates.GetState），
+# 超过 health_ping_timeout 秒无响应视为失活，移出发送分配并重连，重连间隔从 reconnect_backoff_initial 起翻倍直至上限
+health_check_interval = float(config.get('health_check_interval', 30))
+health_update_timeout = float(config.get('health_update_timeout', 300))
+health_ping_timeout = float(config.get('health_ping_timeout', 10))
+reconnect_backoff_initial = float(config.get('reconnect_backoff_initial', 5))
+reconnect_backoff_max = float(config.get('reconnect_backoff_max', 300))
+
+# 多进程分片：shards > 1 时主进程只作为协调者，把启用的账号拆分到多个 worker 进程，
+# 认领/已发送去重与分配计数由协调者通过本地 Unix socket 统一维护
+shard_count = max(1, int(config.get('shards', 1)))
+coordinator_socket_config = config.get('coordinator_socket', 'coordinator.sock')
+if os.path.isabs(coordinator_socket_config):
+    coordinator_socket = coordinator_socket_config
+else:
+    coordinator_socket = os.path.join(os.path.dirname(os.path.abspath(__file__)), coordinator_socket_config)
+coordinator_timeout = float(config.get('coordinator_timeout', 5))
+# 协调者请求失败后在该秒数内改为本地认领，不再逐条等待超时
+coordinator_retry_interval = float(config.get('coordinator_retry_interval', 30))
+# worker 进程由协调者以环境变量 TGUSERBOT_SHARD="序号/总数" 启动
+shard_env = os.environ.get('TGUSERBOT_SHARD')
+shard_index: Optional[int] = int(shard_env.split('/')[0]) if shard_env else None
+if shard_env:
+    shard_count = int(shard_env.split('/')[1])
+
+def shard_suffixed(path: Optional[str], index: Optional[int] = None) -> Optional[str]:
+    """分片 worker 使用各自独立的文件：tasks.db → tasks.shard1.db；index 默认为本进程的分片序号"""
+    if index is None:
+        index = shard_index
+    if not path or index is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}.shard{index}{ext}'
+
+def account_shard(name: str, count: int) -> int:
+    """账号所属的分片：只取决于账号名和分片总数，增删其他账号不会让它换到别的 worker"""
+    digest = hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % count
+
+if shard_index is not None:
+    task_journal_path = shard_suffixed(task_journal_path)
+    startup_cache_path = shard_suffixed(startup_cache_path)
+    media_spool_dir = os.path.join(media_spool_dir, f'shard{shard_index}')
+    if metrics_port:
+        metrics_port += shard_index + 1
+    # worker 的标准输入不可用，需要交互登录的账号一律跳过
+    headless = True
+
+def parse_text_replacements(cfg: dict) -> List[Tuple[str, str, str]]:
+    """解析文案替换规则，支持 text_replacements 列表或 text_prefix_replace 字典
+    
+    每条规则为 (from, to, kind)，kind 为 literal（默认）、prefix（"prefix": true，仅匹配文案开头）
+    或 regex（"regex": true，to 中可使用 \\1 等分组引用）。
+    """
     replacements = []
     for item in cfg.get('text_replacements', []):
         if 'from' in item:
-            replacements.append((item['from'], item.get('to', '')))
+            if item.get('regex'):
+                kind = 'regex'
+            elif item.get('prefix'):
+                kind = 'prefix'
+            else:
+                kind = 'literal'
+            replacements.append((item['from'], item.get('to', ''), kind))
     if not replacements and 'text_prefix_replace' in cfg:
         for from_str, to_str in cfg['text_prefix_replace'].items():
-            replacements.append((from_str, to_str))
+            replacements.append((from_str, to_str, 'literal'))
     return replacements
 
-text_replacements = parse_text_replacements(config)
+class TextReplacer:
+    """在加载配置时把替换规则编译为单次扫描的匹配器
+    
+    文案从左到右只扫描一次：每个位置上取能匹配的最长规则（等长时字面量规则优先，其次按配置顺序），替换后从匹配结束处继续，
+    替换结果不会再被其他规则匹配，因此结果与规则顺序无关。prefix 规则只在文案开头匹配一次。
+    """
+    def __init__(self, rules: List[Tuple[str, str, str]]):
+        self.rules = rules
+        literals = [(f, t) for f, t, kind in rules if kind == 'literal' and f]
+        self._literal_map: Dict[str, str] = {}
+        for from_str, to_str in literals:
+            self._literal_map.setdefault(from_str, to_str)
+        self._regex_rules = [(re.compile(f), t) for f, t, kind in rules if kind == 'regex']
+        self._prefix_rules = [(f, t) for f, t, kind in rules if kind == 'prefix' and f]
+        
+        alternatives = []
+        if self._literal_map:
+            self._literal_re = re.compile(build_trie_pattern(list(self._literal_map)))
+            alternatives.append(self._literal_re.pattern)
+        else:
+            self._literal_re = None
+        alternatives.extend(f'(?:{pattern.pattern})' for pattern, _ in self._regex_rules)
+        self._scanner = re.compile('|'.join(alternatives)) if alternatives else None
+
+    def __bool__(self) -> bool:
+        return bool(self.rules)
 
-def apply_text_replacements(text: str) -> str:
-    """按配置替换文案中的前缀或片段"""
-    if not text or not text_replacements:
-        return text
-    result = text
-    for from_str, to_str in text_replacements:
-        result = result.replace(from_str, to_str)
+    def __repr__(self) -> str:
+        return repr([(f, t) if kind == 'literal' else (f, t, kind) for f, t, kind in self.rules])
+
+    def _literal_repl(self, m: 're.Match') -> str:
+        return self._literal_map[m.group()]
+
+    def _longest_at(self, text: str, pos: int) -> Tuple[int, str]:
+        """返回 pos 处最长匹配的结束位置和替换文本"""
+        best_end, best_repl = pos, None
+        if self._literal_re is not None:
+            m = self._literal_re.match(text, pos)
+            if m:
+                best_end, best_repl = m.end(), self._literal_map[m.group()]
+        for pattern, to_str in self._regex_rules:
+            m = pattern.match(text, pos)
+            if m and m.end() > best_end:
+                best_end, best_repl = m.end(), m.expand(to_str)
+        return best_end, best_repl
+
+    def apply(self, text: str) -> str:
+        if not text or not self.rules:
+            return text
+        out = []
+        pos = 0
+        if self._prefix_rules:
+            matched = max((r for r in self._prefix_rules if text.startswith(r[0])), key=lambda r: len(r[0]), default=None)
+            if matched:
+                out.append(matched[1])
+                pos = len(matched[0])
+        if self._scanner is None:
+            out.append(text[pos:])
+            return ''.join(out)
+        if not self._regex_rules:
+            # 只有字面量时合并正则本身即给出最长匹配，交给 re.sub 在 C 层完成扫描
+            out.append(self._literal_re.sub(self._literal_repl, text[pos:] if pos else text))
+            return ''.join(out)
+        length = len(text)
+        while pos < length:
+            m = self._scanner.search(text, pos)
+            if m is None:
+                break
+            start = m.start()
+            end, repl = self._longest_at(text, start)
+            if repl is None or end == start:
+                # 只有空匹配：原样保留一个字符后继续
+                out.append(text[pos:start + 1])
+                pos = start + 1
+                continue
+            out.append(text[pos:start])
+            out.append(repl)
+            pos = end
+        out.append(text[pos:])
+        return ''.join(out)
+
+def build_trie_pattern(words: List[str]) -> str:
+    """把字面量集合编译为按公共前缀合并的正则（贪婪可选分支保证同一位置取最长匹配）"""
+    trie: dict = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[''] = None
+
+    def build(node: dict) -> str:
+        is_end = '' in node
+        branches = []
+        single_chars = []
+        for ch in sorted(k for k in node if k):
+            child = node[ch]
+            if list(child) == ['']:
+                single_chars.append(re.escape(ch))
+            else:
+                branches.append(re.escape(ch) + build(child))
+        if single_chars:
+            branches.append(single_chars[0] if len(single_chars) == 1 else '[' + ''.join(single_chars) + ']')
+        if not branches:
+            return ''
+        if len(branches) == 1 and not is_end:
+            return branches[0]
+        group = '(?:' + '|'.join(branches) + ')'
+        return group + '?' if is_end else group
+
+    return build(trie)
+
+def compile_replacements(rules: List[Tuple[str, str, str]]) -> TextReplacer:
+    try:
+        return TextReplacer(rules)
+    except re.error as e:
+        raise ValueError(f"文案替换规则中的正则表达式无效: {str(e)}")
+
+class TargetConfig:
+    """一个被监听的源用户：各自的文案替换规则、分配策略和可选的群组范围"""
+    def __init__(self, username: str, replacements: TextReplacer, strategy: str, chats: Optional[FrozenSet[int]]):
+        self.username = username
+        self.replacements = replacements
+        self.distribution_strategy = strategy
+        self.chats = chats
+        # 运行时解析得到
+        self.user_id: Optional[int] = None
+        self.is_bot = False
+
+    def in_scope(self, chat_id: int) -> bool:
+        return self.chats is None or chat_id in self.chats
+
+    def apply_replacements(self, text: str) -> str:
+        return self.replacements.apply(text)
+
+def parse_targets(cfg: dict) -> List[TargetConfig]:
+    """解析监听目标：targets 列表；兼容旧版单个 target_bot_username + 全局文案替换规则"""
+    items = cfg.get('targets') or [{'username': cfg['target_bot_username']}]
+    result = []
+    for item in items:
+        if 'text_replacements' in item or 'text_prefix_replace' in item:
+            rules = parse_text_replacements(item)
+        else:
+            rules = parse_text_replacements(cfg)
+        chats = frozenset(item['chats']) if item.get('chats') else None
+        result.append(TargetConfig(
+            username=item['username'].lstrip('@'),
+            replacements=compile_replacements(rules),
+            strategy=normalize_strategy(item.get('distribution_strategy', cfg.get('distribution_strategy', 'round_robin'))),
+            chats=chats,
+        ))
     return result
 
+try:
+    targets = parse_targets(config)
+except ValueError as e:
+    print(f"错误: {str(e)}")
+    sys.exit(1)
+targets_by_username: Dict[str, TargetConfig] = {t.username.lower(): t for t in targets}
+
 # 配置日志路径（支持相对路径和绝对路径）
 log_dir_config = config.get('log_dir', 'logs')
 if os.path.isabs(log_dir_config):
@@ -105,115 +427,1145 @@ else:
     log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), log_dir_config)
 
 os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, f'tguserbot_{datetime.now().strftime("%Y%m%d")}.log')
 
 log_level = config.get('log_level', 'INFO').upper()
-logging.basicConfig(
-    level=getattr(logging, log_level, logging.INFO),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file, encoding='utf-8'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+# 日志保留天数（0 表示不清理）；后台写日志队列上限（满时丢弃并计数）
+log_retention_days = int(config.get('log_retention_days', 0))
+log_queue_size = int(config.get('log_queue_size', 10000))
+# 逐条消息的 INFO 日志抽样比例（1 全部输出，0 只输出周期汇总）；WARNING 及以上不受影响
+log_message_sample_rate = min(1.0, max(0.0, float(config.get('log_message_sample_rate', 1.0))))
+
+class DailyFileHandler(logging.FileHandler):
+    """按天切换的日志文件 tguserbot_YYYYMMDD.log：跨过午夜后写入新文件，并按保留天数清理旧文件"""
+    def __init__(self, directory: str, prefix: str = 'tguserbot', retention_days: int = 0):
+        self.directory = directory
+        self.prefix = prefix
+        self.retention_days = retention_days
+        now = datetime.now()
+        super().__init__(self._path_for(now), encoding='utf-8')
+        self._next_rollover = self._midnight_after(now)
+        self._purge(now)
+
+    def _path_for(self, day: datetime) -> str:
+        return os.path.join(self.directory, f'{self.prefix}_{day.strftime("%Y%m%d")}.log')
+
+    @staticmethod
+    def _midnight_after(now: datetime) -> float:
+        return datetime(now.year, now.month, now.day).timestamp() + 86400
+
+    def _purge(self, now: datetime) -> None:
+        if self.retention_days <= 0:
+            return
+        cutoff = f'{self.prefix}_{datetime.fromtimestamp(now.timestamp() - self.retention_days * 86400).strftime("%Y%m%d")}.log'
+        for name in os.listdir(self.directory):
+            if name.startswith(f'{self.prefix}_') and name.endswith('.log') and name < cutoff:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if record.created >= self._next_rollover:
+            now = datetime.fromtimestamp(record.created)
+            if self.stream:
+                self.stream.close()
+                self.stream = None
+            self.baseFilename = os.path.abspath(self._path_for(now))
+            self._next_rollover = self._midnight_after(now)
+            self._purge(now)
+        super().emit(record)
+
+class BackgroundQueueHandler(QueueHandler):
+    """事件循环线程只把 LogRecord 放入队列，格式化与磁盘/终端写入由后台线程完成"""
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 同进程内的监听线程可直接使用原始记录，不在调用方线程格式化
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogSampler(logging.Filter):
+    """逐条消息日志的抽样过滤器：未输出的记录按日志模板计数，由周期维护汇总输出"""
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+        self.suppressed: Dict[str, int] = defaultdict(int)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.rate >= 1.0:
+            return True
+        if self.rate > 0 and random.random() < self.rate:
+            return True
+        self.suppressed[record.msg] += 1
+        return False
+
+    def drain(self) -> Dict[str, int]:
+        counts = self.suppressed
+        self.suppressed = defaultdict(int)
+        return counts
+
+if shard_index is None:
+    log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    file_handler = DailyFileHandler(log_dir, retention_days=log_retention_days)
+else:
+    log_formatter = logging.Formatter(f'%(asctime)s - shard{shard_index} - %(name)s - %(levelname)s - %(message)s')
+    file_handler = DailyFileHandler(log_dir, prefix=f'tguserbot_shard{shard_index}', retention_days=log_retention_days)
+file_handler.setFormatter(log_formatter)
+stream_handler = logging.StreamHandler(sys.stdout)
+stream_handler.setFormatter(log_formatter)
+log_file = file_handler.baseFilename
+log_queue_handler = BackgroundQueueHandler(queue.Queue(log_queue_size) if log_queue_size > 0 else queue.SimpleQueue())
+log_listener = QueueListener(log_queue_handler.queue, file_handler, stream_handler, respect_handler_level=True)
+logging.basicConfig(level=getattr(logging, log_level, logging.INFO), handlers=[log_queue_handler])
+log_listener.start()
+atexit.register(log_listener.stop)
 
 logger = logging.getLogger(__name__)
+# 逐条消息的流水日志（收到/匹配/分配/下载/入队/发送），使用 % 参数延迟格式化，可抽样
+message_logger = logging.getLogger(f'{__name__}.messages')
+log_sampler = LogSampler(log_message_sample_rate)
+message_logger.addFilter(log_sampler)
 logger.info(f"日志文件路径: {log_file}")
 logger.info(f"配置了 {len(accounts)} 个账户")
-logger.info(f"分配策略: {distribution_strategy}")
-if text_replacements:
-    logger.info(f"文案替换规则: {text_replacements}")
+for target in targets:
+    scope = f"{len(target.chats)} 个群组" if target.chats is not None else "全部群组"
+    logger.info(f"监听目标 @{target.username}: 分配策略 {target.distribution_strategy}，范围 {scope}，文案替换规则 {target.replacements}")
 
 # 运行时由 main() 填充：仅包含成功启动的账户
 clients: List[TelegramClient] = []
 active_accounts: List[dict] = []
+client_indices: Dict[TelegramClient, int] = {}
 workdir = os.path.dirname(os.path.abspath(__file__))
 
+# 去重存储配置：TTL（秒）与每个存储的最大条目数
+dedup_ttl = float(config.get('dedup_ttl', 6 * 3600))
+dedup_max_entries = int(config.get('dedup_max_entries', 100000))
+status_report_interval = float(config.get('status_report_interval', 600))
+
+# 消息链路追踪：完成的追踪按采样率抽样写入 JSONL，超过慢消息阈值（秒，0 关闭）的一律写入；trace_file 为空则关闭
+trace_file_config = config.get('trace_file', 'traces.jsonl')
+if not trace_file_config:
+    trace_file = None
+elif os.path.isabs(trace_file_config):
+    trace_file = trace_file_config
+else:
+    trace_file = os.path.join(log_dir, trace_file_config)
+trace_file = shard_suffixed(trace_file)
+trace_sample_rate = min(1.0, max(0.0, float(config.get('trace_sample_rate', 0.0))))
+trace_slow_threshold = float(config.get('trace_slow_threshold', 10.0))
+trace_max_bytes = int(config.get('trace_max_bytes', 20 * 1024 * 1024))
+trace_backup_count = int(config.get('trace_backup_count', 5))
+
+class DedupStore:
+    """带 TTL 与容量上限的去重键存储，键为定长哈希整数
+    
+    条目按写入顺序排列（即按过期时间排列），命中时不调整位置也不续期，prune 从头部清理即可清掉全部过期条目。
+    """
+    def __init__(self, name: str, ttl: float = dedup_ttl, max_entries: int = dedup_max_entries):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[int, float]' = OrderedDict()
+        self.hits = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: int) -> bool:
+        expires_at = self._entries.get(key)
+        if expires_at is None:
+            return False
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.expired += 1
+            return False
+        self.hits += 1
+        return True
+
+    def add(self, key: int) -> None:
+        now = time.monotonic()
+        self._entries[key] = now + self.ttl
+        self._entries.move_to_end(key)
+        self.prune(now)
+
+    def prune(self, now: Optional[float] = None) -> None:
+        """从最早写入的一端清理过期条目，并把总量压到上限以内"""
+        if now is None:
+            now = time.monotonic()
+        entries = self._entries
+        while entries:
+            key, expires_at = next(iter(entries.items()))
+            if expires_at > now:
+                break
+            del entries[key]
+            self.expired += 1
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+            self.evicted += 1
+
+    def memory_bytes(self) -> int:
+        """估算占用内存：容器本身 + 每条目的键/过期时间对象 + 链表节点"""
+        per_entry = sys.getsizeof(1 << 63) + sys.getsizeof(0.0) + 32
+        return sys.getsizeof(self._entries) + len(self._entries) * per_entry
+
+    def stats(self) -> dict:
+        return {
+            'name': self.name,
+            'entries': len(self._entries),
+            'memory_bytes': self.memory_bytes(),
+            'hits': self.hits,
+            'expired': self.expired,
+            'evicted': self.evicted,
+        }
+
 start_time = None
-message_queue: asyncio.Queue = None
+send_scheduler: 'SendScheduler' = None
+rate_limiter: 'RateLimiter' = None
+upload_cache: 'UploadCache' = None
+media_budget: 'MediaMemoryBudget' = None
+album_collector: 'AlbumCollector' = None
+task_journal: 'TaskJournal' = None
+trace_writer: 'TraceWriter' = None
+startup_cache: 'StartupCache' = None
+login_lock: asyncio.Lock = None
+coordinator: 'CoordinatorClient' = None
 message_dedup_lock: asyncio.Lock = None
-seen_by_id: Set[Tuple] = set()
-claimed_messages: Set[Tuple] = set()
-sent_messages: Set[Tuple] = set()
+seen_by_id = DedupStore('seen_by_id')
+claimed_messages = DedupStore('claimed')
+sent_messages = DedupStore('sent')
 our_user_ids: Set[int] = set()
+# 已解析的目标用户 ID → 目标配置，handler 中按 sender_id O(1) 分派
+targets_by_id: Dict[int, TargetConfig] = {}
+
+chat_client_index: 'ChatCounters' = None
+chat_client_usage: 'ChatCounters' = None
+account_load: 'AccountLoad' = None
+account_health: 'AccountHealth' = None
+download_pool: 'DownloadPool' = None
+media_cache: 'MediaCache' = None
+chat_progress: 'ChatProgress' = None
+account_supervisors: Dict[int, asyncio.Task] = {}
+reload_lock: asyncio.Lock = None
+pending_reloads: Set[asyncio.Task] = set()
+
+class MediaMemoryBudget:
+    """统计排队中媒体占用的内存字节数，超出预算的媒体改为落盘"""
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
 
-chat_client_index: Dict[int, int] = defaultdict(int)
-chat_client_usage: Dict[int, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+    def reserve(self, size: int) -> bool:
+        if self.used + size > self.limit:
+            return False
+        self.used += size
+        return True
+
+    def charge(self, size: int) -> None:
+        """按实际下载大小记账（可能略超出预估）"""
+        self.used += size
+
+    def release(self, size: int) -> None:
+        self.used = max(0, self.used - size)
 
 class MediaPayload:
-    """下载后的媒体数据，携带文件名和发送方式"""
-    def __init__(self, data: bytes, filename: str, force_document: bool = False):
+    """下载后的媒体数据，携带文件名和发送方式
+    
+    小文件以 bytes 保存在内存（data），大文件或超出内存预算时落盘到 spool 目录（path），
+    发送时由 Telethon 按块从文件读取上传。
+    """
+    def __init__(self, data: Optional[bytes], filename: str, force_document: bool = False,
+                 source_key: Optional[str] = None, path: Optional[str] = None):
         self.data = data
+        self.path = path
         self.filename = filename
         self.force_document = force_document
+        self.source_key = source_key
+        self.size = len(data) if data is not None else os.path.getsize(path)
+        self._content_hash: Optional[str] = None
+
+    @property
+    def in_memory(self) -> bool:
+        return self.data is not None
+
+    @property
+    def upload_source(self):
+        """传给 upload_file 的数据源：内存 bytes 或落盘文件路径"""
+        return self.data if self.data is not None else self.path
+
+    @property
+    def cache_key(self) -> str:
+        """上传缓存键：优先使用源文件 ID，否则使用内容哈希"""
+        if self.source_key:
+            return self.source_key
+        if self._content_hash is None:
+            digest = hashlib.sha256()
+            if self.data is not None:
+                digest.update(self.data)
+            else:
+                with open(self.path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        digest.update(chunk)
+            self._content_hash = 'sha256:' + digest.hexdigest()
+        return self._content_hash
+
+    def persist(self) -> None:
+        """把内存中的数据另存一份到 spool 文件（供任务日志重启恢复），发送仍使用内存数据"""
+        if self.path or self.data is None:
+            return
+        path = new_spool_path(self.filename)
+        with open(path, 'wb') as f:
+            f.write(self.data)
+        self.path = path
+
+    def release(self, keep_file: bool = False) -> None:
+        """任务结束后归还内存预算并删除落盘文件；keep_file 时保留文件供下次启动重放"""
+        if self.data is not None:
+            if media_budget:
+                media_budget.release(len(self.data))
+            self.data = None
+        if self.path and not keep_file:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+class TraceWriter:
+    """将完成的链路追踪写入滚动 JSONL 文件（独立 logger，不进入普通日志）"""
+    def __init__(self, path: str, sample_rate: float, slow_threshold: float, max_bytes: int, backup_count: int):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.written = 0
+        self._handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self._handler.setFormatter(logging.Formatter('%(message)s'))
+        self._logger = logging.getLogger('tguserbot.trace')
+        self._logger.setLevel(logging.INFO)
+        self._logger.propagate = False
+        self._logger.addHandler(self._handler)
+
+    def sample(self) -> bool:
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def is_slow(self, total: float) -> bool:
+        return self.slow_threshold > 0 and total >= self.slow_threshold
+
+    def write(self, record: dict) -> None:
+        self._logger.info(json.dumps(record, ensure_ascii=False))
+        self.written += 1
+
+    def close(self) -> None:
+        self._logger.removeHandler(self._handler)
+        self._handler.close()
+
+class MessageTrace:
+    """单条目标消息从进入 handler 到最终发送的各阶段时间戳（单调时钟）
+    
+    只在启用追踪、且消息通过 handler 开头的廉价过滤后创建；started 为进入 handler 时记录的时间戳。
+    """
+    __slots__ = ('trace_id', 'chat_id', 'message_id', 'listener', 'wall_time', 'started', 'stages', 'sampled')
+
+    def __init__(self, chat_id: int, message_id: int, started: float, listener: Optional[str] = None):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.listener = listener
+        self.started = started
+        self.wall_time = time.time() - (time.monotonic() - started)
+        self.stages: List[Tuple[str, float]] = [('received', self.started)]
+        self.sampled = trace_writer.sample() if trace_writer else False
+
+    def mark(self, stage: str) -> None:
+        self.stages.append((stage, time.monotonic()))
+
+    def to_record(self, outcome: str, account: Optional[str], total: float) -> dict:
+        stages = []
+        previous = self.started
+        for stage, at in self.stages:
+            stages.append({
+                'stage': stage,
+                'at_ms': round((at - self.started) * 1000, 3),
+                'delta_ms': round((at - previous) * 1000, 3),
+            })
+            previous = at
+        return {
+            'trace_id': self.trace_id,
+            'time': datetime.fromtimestamp(self.wall_time, timezone.utc).isoformat(),
+            'chat_id': self.chat_id,
+            'message_id': self.message_id,
+            'listener': self.listener,
+            'account': account,
+            'outcome': outcome,
+            'total_ms': round(total * 1000, 3),
+            'stages': stages,
+        }
+
+def finish_trace(trace: Optional[MessageTrace], outcome: str, account: Optional[str] = None) -> None:
+    """结束追踪：被抽样或超过慢消息阈值时写入追踪文件"""
+    if trace is None or trace_writer is None:
+        return
+    trace.mark(outcome)
+    total = trace.stages[-1][1] - trace.started
+    if not (trace.sampled or trace_writer.is_slow(total)):
+        return
+    try:
+        trace_writer.write(trace.to_record(outcome, account, total))
+    except Exception as e:
+        logger.warning(f"写入链路追踪失败: {str(e)}")
+
+# 发送优先级，数值越小越先发送
+PRIORITY_TEXT = 0
+PRIORITY_MEDIA = 1
+PRIORITY_LARGE_MEDIA = 2
+
+def media_priority(sizes: List[int]) -> int:
+    """按媒体总大小划分优先级，sizes 为空表示纯文字"""
+    if not sizes:
+        return PRIORITY_TEXT
+    return PRIORITY_LARGE_MEDIA if sum(sizes) >= priority_large_media_bytes else PRIORITY_MEDIA
+
+def message_priority(messages: List) -> int:
+    return media_priority([getattr(m.file, 'size', 0) or 0 for m in messages if m.media])
 
 class MessageTask:
-    def __init__(self, chat_id, msg_text, media=None, user_type="", client_index=None, dedup_keys=None):
+    def __init__(self, chat_id, msg_text, media=None, user_type="", client_index=None, dedup_keys=None, captions=None):
         self.chat_id = chat_id
         self.msg_text = msg_text
+        # 单个 MediaPayload，或相册的 MediaPayload 列表（captions 与之一一对应）
         self.media = media
+        self.captions = captions
         self.user_type = user_type
         self.client_index = client_index
         self.dedup_keys = dedup_keys or []
+        self.task_id = uuid.uuid4().hex
+        self.created_at = time.time()
+        # 单调时钟时间戳，用于延迟统计（重放的任务没有 received_at）
+        self.received_at: Optional[float] = None
+        self.enqueued_at: Optional[float] = None
+        self.trace: Optional[MessageTrace] = None
+        self.sent_by: Optional[str] = None
+        # 后台下载媒体的任务，完成后 media/captions 已填好并写入任务日志（无需下载的任务为 None）
+        self.media_ready: Optional[asyncio.Task] = None
+        # 媒体下载完成前原消息的位置 {'account', 'message_ids', 'album'}，写入任务日志供重启后重新下载
+        self.media_source: Optional[dict] = None
+        self.priority = PRIORITY_TEXT
+
+    @property
+    def media_items(self) -> List[MediaPayload]:
+        if not self.media:
+            return []
+        return self.media if isinstance(self.media, list) else [self.media]
 
-def make_id_key(event) -> Tuple:
+    def release_media(self, keep_files: bool = False) -> None:
+        for payload in self.media_items:
+            payload.release(keep_files)
+
+def hash_dedup_key(parts: Tuple) -> int:
+    """将去重元组压缩为定长 64 位有符号整数（可直接存入 SQLite），避免在内存中保留原文"""
+    digest = hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+def make_id_key(event) -> int:
     """按 message.id 快速去重（同 session 内）"""
     chat_id = get_peer_id(event.peer_id)
-    return (chat_id, event.message.sender_id or 0, event.message.id)
+    return hash_dedup_key((chat_id, event.message.sender_id or 0, event.message.id))
+
+def make_album_key(event) -> Optional[int]:
+    """相册（grouped_id）级别的去重键，非相册消息返回 None"""
+    grouped_id = getattr(event.message, 'grouped_id', None)
+    if not grouped_id:
+        return None
+    chat_id = get_peer_id(event.peer_id)
+    return hash_dedup_key((chat_id, event.message.sender_id or 0, 'album', grouped_id))
 
-def make_dedup_keys(event) -> List[Tuple]:
+def make_dedup_keys(event) -> List[int]:
     """生成多条去重键，兼容不同账号收到同一消息时 message.id 不一致的情况"""
     chat_id = get_peer_id(event.peer_id)
     message = event.message
     sender_id = message.sender_id or 0
     keys = []
     
-    if getattr(message, 'grouped_id', None):
-        keys.append((chat_id, sender_id, 'album', message.grouped_id))
+    album_key = make_album_key(event)
+    if album_key is not None:
+        keys.append(album_key)
     
-    keys.append((chat_id, sender_id, message.id))
+    keys.append(hash_dedup_key((chat_id, sender_id, message.id)))
     
     msg_date = int(message.date.timestamp()) if message.date else 0
     content = message.message or ''
     if not content and message.media:
-        content = type(message.media).__name__
-    keys.append((chat_id, sender_id, msg_date, content))
+        # 无文字的媒体（如相册的其余部分）用文件 ID 区分，各账号看到的文件 ID 相同
+        content = resolve_media_source_key(message) or type(message.media).__name__
+    keys.append(hash_dedup_key((chat_id, sender_id, msg_date, content)))
     
     return keys
 
-def is_duplicate(keys: List[Tuple], store: Set[Tuple]) -> bool:
+def make_part_keys(event) -> List[int]:
+    """单条消息自身的去重键（相册部分不含整个相册共用的键），用于登记和匹配备用下载来源"""
+    album_key = make_album_key(event)
+    return [key for key in make_dedup_keys(event) if key != album_key]
+
+def is_duplicate(keys: List[int], store: DedupStore) -> bool:
     return any(k in store for k in keys)
 
-def mark_keys(keys: List[Tuple], store: Set[Tuple]) -> None:
+def mark_keys(keys: List[int], store: DedupStore) -> None:
     for k in keys:
         store.add(k)
 
-def pick_sender_index(chat_id: int) -> int:
-    """为一条消息选定唯一发送账号（与 clientTgUserBot 相同的分配逻辑）"""
+def format_dedup_stats() -> str:
+    parts = []
+    for store in (seen_by_id, claimed_messages, sent_messages):
+        st = store.stats()
+        parts.append(
+            f"{st['name']}: {st['entries']} 条/{st['memory_bytes'] / 1024:.1f}KB, "
+            f"过期 {st['expired']}, 淘汰 {st['evicted']}"
+        )
+    return "；".join(parts)
+
+def format_rate_limit_stats() -> str:
+    parts = []
+    for index, st in rate_limiter.snapshot().items():
+        parts.append(
+            f"{active_accounts[index]['name']}: 冷却 {st['cooldown']:.0f}秒, FloodWait {st['flood_waits']} 次, "
+            f"受限群组 {st['throttled_chats']}, 最低令牌 {st['min_tokens']:.1f}"
+        )
+    return "；".join(parts)
+
+def report_log_summary() -> None:
+    """输出本周期内被抽样省略的逐条日志数量（按模板）以及因队列已满丢弃的日志数"""
+    counts = log_sampler.drain()
+    if counts:
+        total = sum(counts.values())
+        top = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:5]
+        detail = "；".join(f"{count} × {template.split(' - ')[0][:40]}" for template, count in top)
+        logger.info(f"📝 逐条日志抽样省略 {total} 条 - {detail}")
+    if log_queue_handler.dropped:
+        logger.warning(f"日志队列已满，累计丢弃 {log_queue_handler.dropped} 条日志")
+
+async def periodic_maintenance():
+    """定期清理过期去重键与空闲令牌桶，并输出去重存储和各账号限速余量"""
+    while True:
+        try:
+            await asyncio.sleep(status_report_interval)
+            async with message_dedup_lock:
+                for store in (seen_by_id, claimed_messages, sent_messages):
+                    store.prune()
+                summary = format_dedup_stats()
+            if task_journal:
+                task_journal.prune_sent_keys(time.time() - dedup_ttl)
+            logger.info(f"🧹 去重存储状态 - {summary}")
+            rate_limiter.prune()
+            logger.info(f"🚦 限速状态 - {format_rate_limit_stats()}")
+            st = upload_cache.stats()
+            logger.info(f"♻️ 上传缓存 - {st['entries']} 条, 命中 {st['hits']}/未命中 {st['misses']} (命中率 {st['hit_rate']:.0%}), 淘汰 {st['evicted']}, 失效 {st['invalidated']}")
+            st = media_cache.stats()
+            logger.info(f"📦 媒体缓存 - {st['entries']} 条 (内存 {st['memory_bytes']} 字节, 磁盘 {st['disk_bytes']} 字节), 命中 {st['hits']}/未命中 {st['misses']} (命中率 {st['hit_rate']:.0%}), 合并下载 {st['merged']}, 淘汰 {st['evicted']}")
+            report_log_summary()
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            logger.warning(f"周期维护出错: {str(e)}")
+
+# 端到端延迟直方图的桶边界（秒）
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600)
+
+METRIC_HELP = {
+    'tguserbot_messages_received_total': ('counter', '匹配到目标用户的消息数（按监听账号）'),
+    'tguserbot_dedup_checks_total': ('counter', '去重检查次数（stage: seen/claim/send，result: hit/miss）'),
+    'tguserbot_send_total': ('counter', '发送尝试次数（按账号与结果 success/failure/flood_wait/slow_mode）'),
+    'tguserbot_catch_up_messages_total': ('counter', '重连/重启后补抓到的目标消息数（按监听账号）'),
+    'tguserbot_tasks_dropped_total': ('counter', '未发送即丢弃的任务数（reason: queue_full/stale）'),
+    'tguserbot_coordinator_fallback_total': ('counter', '协调者不可用时在本地认领的消息数'),
+    'tguserbot_download_bytes_total': ('counter', '媒体下载字节数'),
+    'tguserbot_download_seconds_total': ('counter', '媒体下载耗时'),
+    'tguserbot_upload_bytes_total': ('counter', '媒体上传字节数'),
+    'tguserbot_upload_seconds_total': ('counter', '媒体上传耗时'),
+    'tguserbot_receive_to_enqueue_seconds': ('histogram', '收到消息到入队的耗时'),
+    'tguserbot_enqueue_to_send_seconds': ('histogram', '入队到发送完成的耗时'),
+    'tguserbot_receive_to_send_seconds': ('histogram', '收到消息到发送完成的端到端耗时'),
+}
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """进程内指标：热路径上只做字典自增与直方图计数，格式化在抓取时才进行"""
+    def __init__(self):
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = defaultdict(float)
+        self.histograms: Dict[str, Histogram] = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name: str, value: float) -> None:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+metrics = Metrics()
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+def collect_gauges() -> List[Tuple[str, str, str, Tuple, float]]:
+    """抓取时即时读取的状态值：(名称, 类型, 说明, 标签, 数值)"""
+    gauges = []
+    if send_scheduler:
+        gauges.append(('tguserbot_queue_depth', 'gauge', '等待发送的任务数', (), send_scheduler.qsize()))
+    if download_pool:
+        gauges.append(('tguserbot_download_queue_depth', 'gauge', '等待后台下载的媒体数', (), download_pool.pending()))
+    if media_budget:
+        gauges.append(('tguserbot_media_memory_bytes', 'gauge', '排队媒体占用的内存字节数', (), media_budget.used))
+    spool_bytes = 0
+    if os.path.isdir(media_spool_dir):
+        for entry in os.scandir(media_spool_dir):
+            try:
+                spool_bytes += entry.stat().st_size
+            except OSError:
+                pass
+    gauges.append(('tguserbot_media_spool_bytes', 'gauge', '落盘媒体占用的磁盘字节数', (), spool_bytes))
+    for store in (seen_by_id, claimed_messages, sent_messages):
+        labels = (('store', store.name),)
+        gauges.append(('tguserbot_dedup_entries', 'gauge', '去重存储条目数', labels, len(store)))
+        gauges.append(('tguserbot_dedup_evictions_total', 'counter', '去重存储因容量淘汰的条目数', labels, store.evicted))
+    if upload_cache:
+        st = upload_cache.stats()
+        gauges.append(('tguserbot_upload_cache_hits_total', 'counter', '上传缓存命中次数', (), st['hits']))
+        gauges.append(('tguserbot_upload_cache_misses_total', 'counter', '上传缓存未命中次数', (), st['misses']))
+    if media_cache:
+        st = media_cache.stats()
+        gauges.append(('tguserbot_media_cache_hits_total', 'counter', '媒体缓存命中次数（免下载）', (), st['hits']))
+        gauges.append(('tguserbot_media_cache_misses_total', 'counter', '媒体缓存未命中次数', (), st['misses']))
+        gauges.append(('tguserbot_media_cache_merged_total', 'counter', '与进行中的同一文件下载合并的次数', (), st['merged']))
+        gauges.append(('tguserbot_media_cache_bytes', 'gauge', '媒体缓存占用的字节数', (('tier', 'memory'),), st['memory_bytes']))
+        gauges.append(('tguserbot_media_cache_bytes', 'gauge', '媒体缓存占用的字节数', (('tier', 'disk'),), st['disk_bytes']))
+    if account_health:
+        now = time.monotonic()
+        for index, account in enumerate(active_accounts):
+            labels = (('account', account['name']),)
+            gauges.append(('tguserbot_account_healthy', 'gauge', '账号连接是否健康（1 参与发送分配，0 已移出）', labels, int(account_health.healthy[index])))
+            gauges.append(('tguserbot_account_update_age_seconds', 'gauge', '距该账号最近一次收到更新的秒数', labels, now - account_health.last_update[index]))
+            gauges.append(('tguserbot_account_reconnects_total', 'counter', '连接监督重连成功的次数', labels, account_health.reconnects[index]))
+    if rate_limiter:
+        for index, st in rate_limiter.snapshot().items():
+            labels = (('account', active_accounts[index]['name']),)
+            gauges.append(('tguserbot_account_cooldown_seconds', 'gauge', '账号 FloodWait 冷却剩余秒数', labels, st['cooldown']))
+    return gauges
+
+def render_metrics() -> str:
+    """按 Prometheus 文本格式输出全部指标"""
+    lines = []
+    by_name: Dict[str, List] = defaultdict(list)
+    for (name, labels), value in metrics.counters.items():
+        by_name[name].append((labels, value))
+    for name, samples in sorted(by_name.items()):
+        kind, help_text = METRIC_HELP.get(name, ('counter', name))
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            lines.append(f'{name}{_format_labels(labels)} {value:g}')
+    for name, histogram in sorted(metrics.histograms.items()):
+        _, help_text = METRIC_HELP.get(name, ('histogram', name))
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound:g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {histogram.count}')
+        lines.append(f'{name}_sum {histogram.sum:g}')
+        lines.append(f'{name}_count {histogram.count}')
+    described = set()
+    for name, kind, help_text, labels, value in collect_gauges():
+        if name not in described:
+            described.add(name)
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+        lines.append(f'{name}{_format_labels(labels)} {value:g}')
+    return '\n'.join(lines) + '\n'
+
+async def handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """极简 HTTP 处理：GET /metrics 返回指标，其余路径 404"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout=5)
+            if not line or line in (b'\r\n', b'\n'):
+                break
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', render_metrics().encode('utf-8')
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.debug(f"指标请求处理出错: {str(e)}")
+    finally:
+        writer.close()
+
+class ChatCounters(OrderedDict):
+    """按群组的分配计数，超过上限时淘汰最久未使用的群组（计数丢失只影响轮询起点）"""
+    def __init__(self, factory, max_entries: int):
+        super().__init__()
+        self.factory = factory
+        self.max_entries = max_entries
+
+    def __missing__(self, chat_id: int):
+        value = self[chat_id] = self.factory()
+        if len(self) > self.max_entries:
+            self.popitem(last=False)
+        return value
+
+    def __getitem__(self, chat_id: int):
+        value = super().__getitem__(chat_id)
+        self.move_to_end(chat_id)
+        return value
+
+class AccountLoad:
+    """各账号的当前负载，供 least_loaded 策略选取负载最低的发送账号
+    
+    负载分 = (已分配未完成的任务数 + 1) × 发送耗时 EWMA + 近期失败分 × failure_penalty。
+    用带版本号的小根堆维护，分数变化时压入新条目、旧条目在弹出时丢弃；
+    选取时跳过处于 FloodWait 冷却中的账号，复杂度 O(log n)。
+    """
+    def __init__(self, count: int, penalty: float, initial_latency: float = 1.0):
+        self.penalty = penalty
+        self.tasks = [0] * count
+        self.latency = [initial_latency] * count
+        self.failures = [0.0] * count
+        self._versions = [0] * count
+        self._heap: List[Tuple[float, int, int]] = []
+        for index in range(count):
+            self._push(index)
+
+    def score(self, index: int) -> float:
+        return (self.tasks[index] + 1) * self.latency[index] + self.failures[index] * self.penalty
+
+    def _push(self, index: int) -> None:
+        self._versions[index] += 1
+        heapq.heappush(self._heap, (self.score(index), self._versions[index], index))
+        # 过期条目过多时重建，堆大小保持在账号数的常数倍
+        if len(self._heap) > 4 * len(self.tasks) + 64:
+            self._heap = [(self.score(i), self._versions[i], i) for i in range(len(self.tasks))]
+            heapq.heapify(self._heap)
+
+    def pick(self) -> int:
+        parked = []
+        chosen = None
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            index = entry[2]
+            if entry[1] != self._versions[index]:
+                continue
+            if rate_limiter.is_parked(index) or not account_health.is_healthy(index):
+                parked.append(entry)
+                continue
+            chosen = index
+            heapq.heappush(self._heap, entry)
+            break
+        for entry in parked:
+            heapq.heappush(self._heap, entry)
+        if chosen is None:
+            # 全部在冷却中或失活：在可用账号中选最早解除冷却的
+            chosen = min(account_health.usable(), key=rate_limiter.cooldown_remaining)
+        return chosen
+
+    def add(self) -> int:
+        """热加载新增账号：追加一个负载槽位并返回其索引"""
+        index = len(self.tasks)
+        self.tasks.append(0)
+        self.latency.append(sum(self.latency) / len(self.latency) if self.latency else 1.0)
+        self.failures.append(0.0)
+        self._versions.append(0)
+        self._push(index)
+        return index
+
+    def reserve(self, index: int) -> None:
+        """消息已分配给该账号（在任务发送完成或被丢弃时 release）"""
+        self.tasks[index] += 1
+        self._push(index)
+
+    def release(self, index: Optional[int]) -> None:
+        if index is None or index >= len(self.tasks):
+            return
+        self.tasks[index] = max(0, self.tasks[index] - 1)
+        self._push(index)
+
+    def record_send(self, index: int, seconds: float, ok: bool) -> None:
+        if ok:
+            self.latency[index] = 0.8 * self.latency[index] + 0.2 * seconds
+            self.failures[index] *= 0.5
+        else:
+            self.failures[index] += 1
+        self._push(index)
+
+def pick_sender_index(chat_id: int, strategy: str = None) -> int:
+    """为一条消息选定唯一发送账号（与 clientTgUserBot 相同的分配逻辑），失活的账号不参与分配"""
     if len(clients) == 0:
         raise ValueError("没有可用的客户端")
     
-    if distribution_strategy == 'round_robin':
-        index = chat_client_index[chat_id] % len(clients)
+    strategy = strategy or distribution_strategy
+    usable = account_health.usable()
+    if strategy == 'round_robin':
+        index = usable[chat_client_index[chat_id] % len(usable)]
         chat_client_index[chat_id] += 1
-        logger.info(f"轮询分配：群组 {chat_id} → {active_accounts[index]['name']} (索引: {index})")
-    elif distribution_strategy == 'random':
+        message_logger.info("轮询分配：群组 %s → %s (索引: %s)", chat_id, active_accounts[index]['name'], index)
+    elif strategy == 'random':
         usage = chat_client_usage[chat_id]
-        usage_counts = [usage.get(i, 0) for i in range(len(clients))]
-        min_usage = min(usage_counts) if usage_counts else 0
-        least_used_indices = [i for i, count in enumerate(usage_counts) if count == min_usage]
+        usage_counts = {i: usage.get(i, 0) for i in usable}
+        min_usage = min(usage_counts.values())
+        least_used_indices = [i for i, count in usage_counts.items() if count == min_usage]
         if len(least_used_indices) > 1:
             index = random.choice(least_used_indices)
         else:
             index = least_used_indices[0]
-        chat_client_usage[chat_id][index] += 1
-        logger.info(f"随机分配（加权）：群组 {chat_id} → {active_accounts[index]['name']} (索引: {index}, 使用次数: {chat_client_usage[chat_id][index]})")
+        usage[index] += 1
+        message_logger.info("随机分配（加权）：群组 %s → %s (索引: %s, 使用次数: %s)", chat_id, active_accounts[index]['name'], index, usage[index])
+    elif strategy == 'least_loaded':
+        index = account_load.pick()
+        message_logger.info("按负载分配：群组 %s → %s (索引: %s, 任务数: %s, 负载分: %.2f)", chat_id, active_accounts[index]['name'], index, account_load.tasks[index], account_load.score(index))
     else:
-        logger.warning(f"未知的分配策略: {distribution_strategy}，使用第一个客户端")
+        logger.warning(f"未知的分配策略: {strategy}，使用第一个客户端")
         index = 0
     
+    account_load.reserve(index)
     return index
 
+class AccountHealth:
+    """各账号的连接健康状态，由连接监督维护；失活的账号不参与发送分配，恢复后自动重新加入"""
+    def __init__(self, count: int):
+        now = time.monotonic()
+        self.healthy = [True] * count
+        self.retired = [False] * count
+        self.last_update = [now] * count
+        self.reconnects = [0] * count
+
+    def is_healthy(self, index: int) -> bool:
+        return self.healthy[index]
+
+    def usable(self) -> List[int]:
+        """可参与分配的账号索引；全部失活时返回全部未停用的账号，任务留在队列中等待恢复或由发送时的回退处理"""
+        indices = [i for i, ok in enumerate(self.healthy) if ok]
+        return indices or [i for i, retired in enumerate(self.retired) if not retired] or list(range(len(self.healthy)))
+
+    def add(self) -> int:
+        self.healthy.append(True)
+        self.retired.append(False)
+        self.last_update.append(time.monotonic())
+        self.reconnects.append(0)
+        return len(self.healthy) - 1
+
+    def retire(self, index: int) -> None:
+        """热加载移除账号：保留索引（已排队的任务由其他账号发送），不再参与分配"""
+        self.healthy[index] = False
+        self.retired[index] = True
+
+    def revive(self, index: int) -> None:
+        self.healthy[index] = True
+        self.retired[index] = False
+        self.touch(index)
+
+    def touch(self, index: int) -> None:
+        self.last_update[index] = time.monotonic()
+
+    def mark_unhealthy(self, index: int, reason: str) -> None:
+        if self.healthy[index]:
+            self.healthy[index] = False
+            logger.warning(f"🩺 [{active_accounts[index]['name']}] 连接失活（{reason}），已移出发送分配，开始重连")
+
+    def mark_healthy(self, index: int) -> None:
+        """重连成功：重新加入发送分配，reconnects 计数变化会触发一次补抓"""
+        self.healthy[index] = True
+        self.reconnects[index] += 1
+        self.touch(index)
+        logger.info(f"🩺 [{active_accounts[index]['name']}] 已重新连接，恢复参与发送分配（累计重连 {self.reconnects[index]} 次）")
+
+class ClaimCoordinator:
+    """多进程模式下协调者持有的共享状态：认领/已发送去重键与各群组按账号名的发送计数
+    
+    协调者单线程处理请求，同一去重键只会被一个 worker 认领成功。
+    """
+    def __init__(self):
+        self.claimed = DedupStore('coordinator_claimed')
+        self.sent = DedupStore('coordinator_sent')
+        self.usage = ChatCounters(lambda: defaultdict(int), distribution_max_chats)
+        self.granted = 0
+        self.rejected = 0
+
+    def claim(self, keys: List[int], chat_id: int, strategy: str, candidates: List[str]) -> Optional[str]:
+        """认领成功时返回在候选账号（认领 worker 自己的账号）中选定的发送账号名"""
+        if is_duplicate(keys, self.claimed) or is_duplicate(keys, self.sent):
+            self.rejected += 1
+            return None
+        mark_keys(keys, self.claimed)
+        self.granted += 1
+        return self.pick(chat_id, strategy, candidates)
+
+    def pick(self, chat_id: int, strategy: str, candidates: List[str]) -> str:
+        """在候选账号中选该群组累计使用最少的：round_robin 取靠前者（即轮询），random 随机打破平局"""
+        usage = self.usage[chat_id]
+        min_usage = min(usage.get(name, 0) for name in candidates)
+        least_used = [name for name in candidates if usage.get(name, 0) == min_usage]
+        name = random.choice(least_used) if strategy == 'random' else least_used[0]
+        usage[name] += 1
+        return name
+
+    def mark_sent(self, keys: List[int]) -> None:
+        mark_keys(keys, self.sent)
+
+    async def load_journals(self, paths: List[str]) -> None:
+        """启动 worker 前从各分片的任务日志载入已发送键和未完成任务的键
+        
+        协调者的去重状态只在内存中，重启后据此恢复：其他分片补抓到重启前已复制或仍待重放的消息时会被拒绝。
+        """
+        sent = pending = 0
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            journal = TaskJournal(path, 0)
+            try:
+                journal.open()
+                keys = journal.load_sent_keys(time.time() - dedup_ttl)
+                mark_keys(keys, self.sent)
+                sent += len(keys)
+                for row in journal.load_pending():
+                    mark_keys(row['dedup_keys'], self.claimed)
+                    pending += 1
+            except sqlite3.Error as e:
+                logger.warning(f"读取分片任务日志 {path} 失败: {str(e)}")
+            finally:
+                await journal.close()
+        logger.info(f"🧭 协调者从 {len(paths)} 个分片任务日志载入 {sent} 个已发送去重键、{pending} 条未完成任务")
+
+    def prune(self) -> None:
+        self.claimed.prune()
+        self.sent.prune()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """每行一个 JSON 请求；带 id 的请求按行返回 {"id": ..., "result": ...}"""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                op = request.get('op')
+                if op == 'claim':
+                    result = self.claim(request['keys'], request['chat_id'], request['strategy'], request['candidates'])
+                elif op == 'sent':
+                    self.mark_sent(request['keys'])
+                    result = True
+                elif op == 'claimed':
+                    mark_keys(request['keys'], self.claimed)
+                    result = True
+                else:
+                    result = None
+                if request.get('id') is not None:
+                    writer.write(json.dumps({'id': request['id'], 'result': result}).encode('utf-8') + b'\n')
+                    await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.warning(f"协调者处理请求出错: {str(e)}")
+        finally:
+            writer.close()
+
+# 协调者不可用期间暂存的去重键上限（每类），恢复后补报
+COORDINATOR_DEFER_MAX = 10000
+# 每条补报消息携带的键数（协调者按行读取，单行不能过长）
+COORDINATOR_BATCH_KEYS = 1000
+
+class CoordinatorClient:
+    """分片 worker 到协调者的连接：按行收发 JSON，请求与响应以 id 对应，断开后在下次请求时重连
+    
+    请求失败（超时或连接失败）后进入熔断：retry_interval 秒内不再请求，由调用方在本地认领，
+    期间本地认领和发送的去重键暂存起来，恢复后补报给协调者。
+    """
+    def __init__(self, path: str, timeout: float, retry_interval: float):
+        self.path = path
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.failures = 0
+        self._retry_at = 0.0
+        self._deferred: Dict[str, List[int]] = {'claimed': [], 'sent': []}
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._read_task: Optional[asyncio.Task] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._next_id = 0
+        self._connect_lock = asyncio.Lock()
+
+    async def _ensure_connected(self) -> None:
+        async with self._connect_lock:
+            if self._writer is not None and not self._writer.is_closing():
+                return
+            self._reader, self._writer = await asyncio.wait_for(asyncio.open_unix_connection(self.path), timeout=self.timeout)
+            self._read_task = asyncio.create_task(self._read_loop(self._reader, self._writer))
+
+    async def _read_loop(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = json.loads(line)
+                future = self._pending.pop(response['id'], None)
+                if future and not future.done():
+                    future.set_result(response['result'])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"读取协调者响应出错: {str(e)}")
+        finally:
+            writer.close()
+            error = ConnectionError("与协调者的连接已断开")
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self._pending.clear()
+
+    async def request(self, op: str, **payload):
+        await self._ensure_connected()
+        self._next_id += 1
+        request_id = self._next_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        self._writer.write(json.dumps({'id': request_id, 'op': op, **payload}).encode('utf-8') + b'\n')
+        try:
+            return await asyncio.wait_for(future, timeout=self.timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    def available(self) -> bool:
+        return time.monotonic() >= self._retry_at
+
+    def mark_failed(self, error: Exception) -> None:
+        if self.available():
+            logger.warning(f"⚠️ 协调者不可用（{str(error) or type(error).__name__}），{self.retry_interval:g} 秒内改为本地认领，各分片之间可能重复复制")
+        self.failures += 1
+        self._retry_at = time.monotonic() + self.retry_interval
+
+    def defer(self, op: str, keys: List[int]) -> None:
+        """协调者不可用时暂存去重键，超出上限时丢弃最早的"""
+        deferred = self._deferred[op]
+        deferred.extend(keys)
+        if len(deferred) > COORDINATOR_DEFER_MAX:
+            del deferred[:len(deferred) - COORDINATOR_DEFER_MAX]
+
+    async def _flush_deferred(self) -> None:
+        for op, keys in self._deferred.items():
+            if not keys:
+                continue
+            self._deferred[op] = []
+            for start in range(0, len(keys), COORDINATOR_BATCH_KEYS):
+                await self.notify(op, keys=keys[start:start + COORDINATOR_BATCH_KEYS])
+            logger.info(f"🧭 已向协调者补报 {len(keys)} 个{'认领' if op == 'claimed' else '已发送'}去重键")
+
+    async def notify(self, op: str, **payload) -> None:
+        """无需响应的通知（如已发送去重键）；熔断期间或发送失败时暂存，恢复后补报"""
+        if not self.available():
+            self.defer(op, payload['keys'])
+            return
+        try:
+            await self._ensure_connected()
+            self._writer.write(json.dumps({'op': op, **payload}).encode('utf-8') + b'\n')
+        except Exception as e:
+            logger.warning(f"通知协调者失败（{op}）: {str(e)}")
+            self.mark_failed(e)
+            self.defer(op, payload['keys'])
+
+    async def claim(self, keys: List[int], chat_id: int, strategy: str, candidates: List[str]) -> Optional[str]:
+        """向协调者认领；失败时进入熔断并抛出异常"""
+        try:
+            result = await self.request('claim', keys=keys, chat_id=chat_id, strategy=strategy, candidates=candidates)
+        except Exception as e:
+            self.mark_failed(e)
+            raise
+        if any(self._deferred.values()):
+            await self._flush_deferred()
+        return result
+
+    async def close(self) -> None:
+        if self._read_task:
+            self._read_task.cancel()
+            await asyncio.gather(self._read_task, return_exceptions=True)
+        if self._writer:
+            self._writer.close()
+
+async def claim_message(dedup_keys: List[int], chat_id: int, strategy: str) -> Optional[int]:
+    """认领一条目标消息并选定发送账号，已被认领或已发送时返回 None（调用方需持有 message_dedup_lock）
+    
+    分片模式下由协调者在所有 worker 之间裁决，发送账号从本 worker 的账号中选取。
+    协调者不可用时的失败策略：在本地认领并照常发送（宁可分片之间偶尔重复，也不丢消息），
+    熔断期间不再请求协调者，恢复后补报这段时间本地认领的键。
+    """
+    if is_duplicate(dedup_keys, claimed_messages) or is_duplicate(dedup_keys, sent_messages):
+        return None
+    if coordinator is None:
+        mark_keys(dedup_keys, claimed_messages)
+        return pick_sender_index(chat_id, strategy)
+    if coordinator.available():
+        candidates = [active_accounts[i]['name'] for i in account_health.usable()]
+        try:
+            name = await coordinator.claim(dedup_keys, chat_id, strategy or distribution_strategy, candidates)
+        except Exception:
+            # 已由 coordinator.claim 记录并进入熔断，按失败策略在本地认领
+            pass
+        else:
+            # 无论结果如何都记入本地，本 worker 其他账号收到的同一消息不必再询问协调者
+            mark_keys(dedup_keys, claimed_messages)
+            if name is None:
+                return None
+            if (strategy or distribution_strategy) == 'least_loaded':
+                # 负载只在本 worker 内可见，认领成功后在本地按负载选取
+                return pick_sender_index(chat_id, strategy)
+            index = next(i for i, account in enumerate(active_accounts) if account['name'] == name)
+            account_load.reserve(index)
+            message_logger.info("协调者分配：群组 %s → %s (索引: %s)", chat_id, name, index)
+            return index
+    mark_keys(dedup_keys, claimed_messages)
+    coordinator.defer('claimed', dedup_keys)
+    metrics.inc('tguserbot_coordinator_fallback_total')
+    return pick_sender_index(chat_id, strategy)
+
+def resolve_media_source_key(message) -> Optional[str]:
+    """原始媒体的文件 ID（同一文件在不同群组中 ID 相同）"""
+    media = message.media
+    if isinstance(media, MessageMediaPhoto) and media.photo:
+        return f"photo:{media.photo.id}"
+    if isinstance(media, MessageMediaDocument) and media.document:
+        return f"doc:{media.document.id}"
+    return None
+
 def resolve_media_send_info(message) -> Tuple[str, bool]:
     """根据原始消息媒体类型，确定文件名和是否作为文件发送"""
     media = message.media
@@ -245,224 +1597,1859 @@ def resolve_media_send_info(message) -> Tuple[str, bool]:
         return 'file.bin', True
     return 'file.bin', True
 
+def new_spool_path(filename: str) -> str:
+    ext = os.path.splitext(filename)[1]
+    return os.path.join(media_spool_dir, f"{uuid.uuid4().hex}{ext}")
+
 async def download_message_media(event) -> Optional[MediaPayload]:
-    """用监听账号下载媒体，保留类型信息以便正确发送图片/视频"""
+    """用监听账号下载媒体，保留类型信息以便正确发送图片/视频
+    
+    预估大小不超过 media_spool_threshold 且内存预算充足时下载到内存，否则直接流式写入 spool 文件。
+    """
     if not event.message.media:
         return None
+    reserved = 0
     try:
         filename, force_document = resolve_media_send_info(event.message)
-        data = await event.client.download_media(event.message, bytes)
-        if data:
-            logger.info(f"已下载媒体: {filename} ({len(data)} 字节, force_document={force_document})")
-            return MediaPayload(data, filename, force_document)
+        source_key = resolve_media_source_key(event.message)
+        expected_size = event.message.file.size if event.message.file else None
+        started = time.monotonic()
+        if expected_size is not None and expected_size <= media_spool_threshold and media_budget.reserve(expected_size):
+            reserved = expected_size
+            data = await event.client.download_media(event.message, bytes)
+            if data:
+                media_budget.release(reserved)
+                reserved = 0
+                media_budget.charge(len(data))
+                metrics.inc('tguserbot_download_bytes_total', len(data))
+                metrics.inc('tguserbot_download_seconds_total', time.monotonic() - started)
+                message_logger.info("已下载媒体: %s (%s 字节, force_document=%s)", filename, len(data), force_document)
+                return MediaPayload(data, filename, force_document, source_key)
+        else:
+            path = await event.client.download_media(event.message, new_spool_path(filename))
+            if path and os.path.exists(path):
+                payload = MediaPayload(None, filename, force_document, source_key, path=path)
+                metrics.inc('tguserbot_download_bytes_total', payload.size)
+                metrics.inc('tguserbot_download_seconds_total', time.monotonic() - started)
+                message_logger.info("已下载媒体到磁盘: %s (%s 字节, force_document=%s, 内存占用 %s 字节)", filename, payload.size, force_document, media_budget.used)
+                return payload
         logger.warning("媒体下载结果为空")
     except Exception as e:
         logger.warning(f"媒体下载失败，将尝试仅发送文本: {str(e)}")
+    finally:
+        if reserved:
+            media_budget.release(reserved)
     return None
 
-async def send_task_message(client: TelegramClient, task: MessageTask) -> None:
-    """发送单条任务消息"""
-    if task.media:
-        media_file = io.BytesIO(task.media.data)
-        media_file.name = task.media.filename
-        await client.send_file(
-            task.chat_id,
-            media_file,
-            caption=task.msg_text or None,
-            force_document=task.media.force_document
-        )
-    else:
-        await client.send_message(task.chat_id, task.msg_text)
+def clear_media_spool(keep: Optional[Set[str]] = None) -> None:
+    """启动时清理上次运行残留的落盘媒体（keep 中为任务日志仍引用的文件）"""
+    os.makedirs(media_spool_dir, exist_ok=True)
+    removed = 0
+    for name in os.listdir(media_spool_dir):
+        path = os.path.join(media_spool_dir, name)
+        if keep and os.path.abspath(path) in keep:
+            continue
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+    if removed:
+        logger.info(f"已清理 {removed} 个残留的落盘媒体文件: {media_spool_dir}")
 
-async def enqueue_target_message(event, listener_name: str, chat_id: int, msg_text: str, media: Optional[MediaPayload], user_type: str, dedup_keys: List[Tuple], client_index: int) -> bool:
-    """将已认领的消息入队（去重在 handler 中完成）"""
-    sender_name = active_accounts[client_index]['name']
-    task = MessageTask(
-        chat_id=chat_id,
-        msg_text=msg_text,
-        media=media,
-        user_type=user_type,
-        client_index=client_index,
-        dedup_keys=dedup_keys
-    )
-    await message_queue.put(task)
-    if media:
-        media_hint = f"，含媒体 {media.filename} ({len(media.data)} 字节)"
+def link_or_copy(src: str, dst: str) -> None:
+    """优先硬链接（不占额外空间，各自删除互不影响），跨文件系统时复制"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+class CachedMedia:
+    __slots__ = ('data', 'path', 'size')
+
+    def __init__(self, data: Optional[bytes], path: Optional[str], size: int):
+        self.data = data
+        self.path = path
+        self.size = size
+
+def write_file(path: str, data: bytes) -> None:
+    with open(path, 'wb') as f:
+        f.write(data)
+
+async def clone_media(payload: Union[MediaPayload, CachedMedia], message) -> MediaPayload:
+    """为另一条消息生成独立的 MediaPayload：内存数据共享同一 bytes（按新任务记入内存预算），落盘文件在线程中链接到新的 spool 路径"""
+    filename, force_document = resolve_media_send_info(message)
+    source_key = resolve_media_source_key(message)
+    data = payload.data
+    if data is not None:
+        media_budget.charge(len(data))
+        return MediaPayload(data, filename, force_document, source_key)
+    path = new_spool_path(filename)
+    await asyncio.to_thread(link_or_copy, payload.path, path)
+    return MediaPayload(None, filename, force_document, source_key, path=path)
+
+class MediaCache:
+    """已下载媒体的内容缓存，键为源文件 ID + 大小（同一文件发往多个群组时各条消息的键相同）
+    
+    小文件以 bytes 缓存在内存，大文件以硬链接/副本缓存在磁盘目录，各自按字节上限淘汰最久未用的条目；
+    从内存淘汰的条目在磁盘层可用时转存到磁盘。命中时为每个任务生成独立的 MediaPayload，任务结束释放媒体不影响缓存。
+    链接、复制和转存都在线程中进行，不阻塞事件循环；等待期间条目可能已被淘汰，完成后需重新核对。
+    """
+    def __init__(self, memory_limit: int, disk_limit: int, directory: str):
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.directory = directory
+        self._entries: 'OrderedDict[str, CachedMedia]' = OrderedDict()
+        self.memory_used = 0
+        self.disk_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.merged = 0
+        self.evicted = 0
+        self._evict_lock = asyncio.Lock()
+
+    @staticmethod
+    def content_key(message) -> Optional[str]:
+        source_key = resolve_media_source_key(message)
+        size = message.file.size if message.file else None
+        if source_key is None or size is None:
+            return None
+        return f"{source_key}:{size}"
+
+    def open(self) -> None:
+        """清空上次运行留下的缓存文件（缓存索引不跨进程保存）"""
+        if self.disk_limit <= 0:
+            return
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def close(self) -> None:
+        for entry in self._entries.values():
+            self._drop_file(entry.path)
+        self._entries.clear()
+        self.memory_used = self.disk_used = 0
+
+    async def get(self, key: str, message) -> Optional[MediaPayload]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        try:
+            payload = await clone_media(entry, message)
+        except OSError as e:
+            logger.warning(f"读取媒体缓存失败，重新下载: {str(e)}")
+            if self._entries.get(key) is entry:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        message_logger.info("♻️ 媒体缓存命中: %s (%s 字节)", key, entry.size)
+        return payload
+
+    async def put(self, key: str, payload: MediaPayload) -> None:
+        if key in self._entries:
+            return
+        if payload.data is not None and payload.size <= self.memory_limit:
+            self._entries[key] = CachedMedia(payload.data, None, payload.size)
+            self.memory_used += payload.size
+        elif payload.path and payload.size <= self.disk_limit:
+            path = os.path.join(self.directory, uuid.uuid4().hex)
+            try:
+                await asyncio.to_thread(link_or_copy, payload.path, path)
+            except OSError as e:
+                logger.warning(f"写入媒体缓存失败: {str(e)}")
+                return
+            if key in self._entries:
+                self._drop_file(path)
+                return
+            self._entries[key] = CachedMedia(None, path, payload.size)
+            self.disk_used += payload.size
+        else:
+            return
+        await self._evict()
+
+    async def _evict(self) -> None:
+        """先把超出内存上限的最久未用条目转存到磁盘（或丢弃），再淘汰超出磁盘上限的条目"""
+        async with self._evict_lock:
+            for key in list(self._entries):
+                if self.memory_used <= self.memory_limit:
+                    break
+                entry = self._entries.get(key)
+                if entry is None or entry.data is None:
+                    continue
+                if entry.size > self.disk_limit:
+                    self._remove(key)
+                    self.evicted += 1
+                    continue
+                data = entry.data
+                path = os.path.join(self.directory, uuid.uuid4().hex)
+                try:
+                    await asyncio.to_thread(write_file, path, data)
+                except OSError:
+                    if self._entries.get(key) is entry:
+                        self._remove(key)
+                        self.evicted += 1
+                    continue
+                if self._entries.get(key) is not entry or entry.data is not data:
+                    # 转存期间条目已被淘汰
+                    self._drop_file(path)
+                    continue
+                self.memory_used -= entry.size
+                entry.data = None
+                entry.path = path
+                self.disk_used += entry.size
+            self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        for key in list(self._entries):
+            if self.disk_used <= self.disk_limit:
+                break
+            if self._entries[key].path:
+                self._remove(key)
+                self.evicted += 1
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        if entry.data is not None:
+            self.memory_used -= entry.size
+        else:
+            self.disk_used -= entry.size
+            self._drop_file(entry.path)
+
+    @staticmethod
+    def _drop_file(path: Optional[str]) -> None:
+        if path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'memory_bytes': self.memory_used,
+            'disk_bytes': self.disk_used,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'merged': self.merged,
+            'evicted': self.evicted,
+        }
+
+# 暂存的先到备用下载来源条数上限（按去重键计）
+EARLY_SOURCES_MAX = 1000
+
+class DownloadJob:
+    """一个待下载的媒体：可由任一收到该消息的监听账号下载，先到的重复事件会被登记为备用来源"""
+    def __init__(self, event, dedup_keys: List[int]):
+        self.sources: List = [event]
+        self.dedup_keys = dedup_keys
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+class DownloadPool:
+    """有界的媒体下载 worker 池
+    
+    每个任务优先交给当前下载数最少的监听账号，失败时换用其他收到该消息的账号。
+    下载前先查媒体缓存；同一源文件正在下载时不再排队，等待该次下载完成后各自取得独立副本。
+    """
+    def __init__(self, workers: int):
+        self.size = workers
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._workers: List[asyncio.Task] = []
+        self._active: Dict[TelegramClient, int] = defaultdict(int)
+        self._jobs_by_key: Dict[int, DownloadJob] = {}
+        # 先于下载任务到达的重复事件（去重键 → 事件），任务创建时并入其备用来源
+        self._early_sources: 'OrderedDict[int, List]' = OrderedDict()
+        # 源文件键 → 等待同一次下载结果的 (future, 消息) 列表
+        self._flights: Dict[str, List[Tuple[asyncio.Future, object]]] = {}
+
+    def start(self) -> None:
+        for _ in range(self.size - len(self._workers)):
+            self._workers.append(asyncio.create_task(self._worker()))
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    async def download(self, event, dedup_keys: Optional[List[int]] = None) -> Optional[MediaPayload]:
+        key = MediaCache.content_key(event.message) if event.message.media else None
+        while key is not None:
+            payload = await media_cache.get(key, event.message)
+            if payload is not None:
+                return payload
+            waiters = self._flights.get(key)
+            if waiters is None:
+                break
+            future = asyncio.get_running_loop().create_future()
+            waiters.append((future, event.message))
+            media_cache.merged += 1
+            payload = await future
+            if payload is not None:
+                return payload
+            # 合并的那次下载失败或被取消：自己重新尝试
+        if key is None:
+            return await self._download(event, dedup_keys)
+        self._flights[key] = []
+        payload = None
+        try:
+            payload = await self._download(event, dedup_keys)
+            if payload is not None:
+                await media_cache.put(key, payload)
+            return payload
+        finally:
+            await self._share(payload, self._flights.pop(key))
+
+    @staticmethod
+    async def _share(payload: Optional[MediaPayload], waiters: List[Tuple[asyncio.Future, object]]) -> None:
+        """为合并到同一次下载的其他消息各生成独立副本；下载失败、复制失败或被取消时让它们自行重试"""
+        try:
+            if payload is not None:
+                for future, message in waiters:
+                    if not future.done():
+                        future.set_result(await clone_media(payload, message))
+        except OSError as e:
+            logger.warning(f"复制合并下载的媒体失败: {str(e)}")
+        finally:
+            for future, _ in waiters:
+                if not future.done():
+                    future.set_result(None)
+
+    async def _download(self, event, dedup_keys: Optional[List[int]]) -> Optional[MediaPayload]:
+        job = DownloadJob(event, dedup_keys or [])
+        for key in job.dedup_keys:
+            self._jobs_by_key[key] = job
+            for source in self._early_sources.pop(key, ()):
+                if all(existing.client is not source.client for existing in job.sources):
+                    job.sources.append(source)
+        self._queue.put_nowait(job)
+        try:
+            return await job.future
+        finally:
+            for key in job.dedup_keys:
+                if self._jobs_by_key.get(key) is job:
+                    del self._jobs_by_key[key]
+
+    def add_source(self, dedup_keys: List[int], event) -> bool:
+        """其他账号收到的同一条消息：若其媒体仍在等待下载，登记为备用来源
+        
+        认领账号的下载任务可能还未创建（仍在认领或入队），此时先暂存，最多保留 EARLY_SOURCES_MAX 条。
+        """
+        for key in dedup_keys:
+            job = self._jobs_by_key.get(key)
+            if job is not None:
+                if job.future.done():
+                    return False
+                if all(source.client is not event.client for source in job.sources):
+                    job.sources.append(event)
+                return True
+        for key in dedup_keys:
+            self._early_sources.setdefault(key, []).append(event)
+            self._early_sources.move_to_end(key)
+        while len(self._early_sources) > EARLY_SOURCES_MAX:
+            self._early_sources.popitem(last=False)
+        return False
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                if not job.future.done():
+                    job.future.set_result(await self._run(job))
+            except asyncio.CancelledError:
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: DownloadJob) -> Optional[MediaPayload]:
+        tried = []
+        while len(tried) < len(job.sources):
+            source = min((s for s in job.sources if s not in tried), key=lambda s: self._active[s.client])
+            tried.append(source)
+            self._active[source.client] += 1
+            try:
+                payload = await download_message_media(source)
+            finally:
+                self._active[source.client] -= 1
+            if payload is not None:
+                return payload
+        return None
+
+async def load_task_media(task: MessageTask, loader) -> None:
+    """等待后台下载完成并填入任务，然后把任务日志中的原消息位置替换为落盘媒体路径"""
+    try:
+        await loader(task)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.warning(f"后台下载媒体失败，将尝试仅发送文本: {str(e)}")
+    if task.trace:
+        task.trace.mark('downloaded')
+    task.media_source = None
+    if task_journal:
+        await task_journal.record_task(task)
+
+class UploadCache:
+    """按账号缓存已上传的文件句柄（InputFile），同一文件重复发送时直接引用，不再重新上传
+    
+    Telegram 的上传句柄不到一天就会失效，因此条目带 TTL；条目数超过上限时淘汰最久未用的。
+    """
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[Tuple[int, str], Tuple[object, float]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.invalidated = 0
+
+    def get(self, index: int, key: str):
+        entry = self._entries.get((index, key))
+        if entry is None:
+            self.misses += 1
+            return None
+        handle, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[(index, key)]
+            self.evicted += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end((index, key))
+        self.hits += 1
+        return handle
+
+    def put(self, index: int, key: str, handle) -> None:
+        self._entries[(index, key)] = (handle, time.monotonic() + self.ttl)
+        self._entries.move_to_end((index, key))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evicted += 1
+
+    def invalidate(self, index: int, key: str) -> None:
+        if self._entries.pop((index, key), None) is not None:
+            self.invalidated += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evicted': self.evicted,
+            'invalidated': self.invalidated,
+        }
+
+# 上传句柄失效时 Telegram 返回的错误，遇到后重新上传一次
+UPLOAD_HANDLE_ERRORS = (FilePartMissingError, FilePartsInvalidError, FilePart0MissingError, MediaEmptyError)
+
+async def get_upload_handle(index: int, media: MediaPayload):
+    """取得该账号下媒体的上传句柄，缓存未命中时上传一次并缓存"""
+    key = media.cache_key
+    handle = upload_cache.get(index, key)
+    if handle is None:
+        started = time.monotonic()
+        handle = await clients[index].upload_file(media.upload_source, file_name=media.filename)
+        metrics.inc('tguserbot_upload_bytes_total', media.size)
+        metrics.inc('tguserbot_upload_seconds_total', time.monotonic() - started)
+        upload_cache.put(index, key, handle)
+        message_logger.info("⬆️ [%s] 已上传媒体 %s (%s 字节)", active_accounts[index]['name'], media.filename, media.size)
+    else:
+        message_logger.info("♻️ [%s] 复用已上传的媒体 %s", active_accounts[index]['name'], media.filename)
+    return handle
+
+async def send_task_message(index: int, task: MessageTask) -> None:
+    """用指定账号发送单条任务消息（相册作为一组文件一次发送）"""
+    client = clients[index]
+    items = task.media_items
+    if items:
+        for attempt in range(2):
+            handles = await asyncio.gather(*(get_upload_handle(index, m) for m in items))
+            try:
+                if isinstance(task.media, list):
+                    await client.send_file(
+                        task.chat_id,
+                        list(handles),
+                        caption=task.captions or task.msg_text or None,
+                        force_document=items[0].force_document
+                    )
+                else:
+                    await client.send_file(
+                        task.chat_id,
+                        handles[0],
+                        caption=task.msg_text or None,
+                        force_document=task.media.force_document
+                    )
+                return
+            except UPLOAD_HANDLE_ERRORS:
+                for m in items:
+                    upload_cache.invalidate(index, m.cache_key)
+                if attempt:
+                    raise
+                logger.warning(f"[{active_accounts[index]['name']}] 缓存的上传句柄已失效，重新上传")
+    else:
+        await client.send_message(task.chat_id, task.msg_text)
+
+async def enqueue_target_message(event, listener_name: str, chat_id: int, msg_text: str, media: Union[MediaPayload, List[MediaPayload], None], user_type: str, dedup_keys: List[int], client_index: int, captions: Optional[List[str]] = None, received_at: Optional[float] = None, trace: Optional[MessageTrace] = None, media_loader=None, priority: Optional[int] = None, media_source: Optional[dict] = None) -> bool:
+    """将已认领的消息入队（去重在 handler 中完成），队列已满且等待超时时丢弃并返回 False
+    
+    media_loader 为异步函数 loader(task)：任务立即入队，媒体在后台下载并填入任务，发送 worker 在发送前等待。
+    任务在入队前写入任务日志，媒体尚未下载时记录 media_source，重启后据此重新下载。
+    priority 未指定时按 event 的媒体大小确定。
+    """
+    task = MessageTask(
+        chat_id=chat_id,
+        msg_text=msg_text,
+        media=media,
+        user_type=user_type,
+        client_index=client_index,
+        dedup_keys=dedup_keys,
+        captions=captions
+    )
+    if client_index is None:
+        logger.error("任务未指定发送账号，跳过")
+        task.release_media()
+        return False
+    sender_name = active_accounts[client_index]['name']
+    task.trace = trace
+    task.priority = message_priority([event.message]) if priority is None else priority
+    if media_loader is not None:
+        task.media_source = media_source
+    if task_journal:
+        await task_journal.record_task(task)
+        if trace:
+            trace.mark('journaled')
+    if media_loader is not None:
+        task.media_ready = asyncio.create_task(load_task_media(task, media_loader))
+    task.enqueued_at = time.monotonic()
+    if trace:
+        trace.mark('enqueued')
+    if received_at is not None:
+        task.received_at = received_at
+        metrics.observe('tguserbot_receive_to_enqueue_seconds', task.enqueued_at - received_at)
+    if not await send_scheduler.put(task):
+        discard_task(task, 'queue_full')
+        logger.warning(f"🗑️ [{listener_name}] 发送队列已满（{send_scheduler.qsize()} 条），等待 {send_scheduler.full_timeout:g} 秒后仍无空位，丢弃群组 {chat_id} 的消息")
+        return False
+    if not message_logger.isEnabledFor(logging.INFO):
+        return True
+    if media_loader is not None:
+        media_hint = "，媒体后台下载中"
+    elif isinstance(media, list):
+        media_hint = f"，含相册 {len(media)} 个文件 ({sum(m.size for m in media)} 字节)"
+    elif media:
+        location = "内存" if media.in_memory else "磁盘"
+        media_hint = f"，含媒体 {media.filename} ({media.size} 字节, {location})"
     else:
         media_hint = ""
-    logger.info(f"📥 [{listener_name}] 消息已入队 → 指定由 [{sender_name}] 发送{media_hint}（去重键: {dedup_keys}，队列: {message_queue.qsize()}）")
+    trace_hint = f"，追踪: {trace.trace_id}" if trace else ""
+    message_logger.info("📥 [%s] 消息已入队 → 指定由 [%s] 发送%s（去重键: %s，队列: %s%s）", listener_name, sender_name, media_hint, dedup_keys, send_scheduler.qsize(), trace_hint)
     return True
 
-async def message_sender():
-    """消息发送任务，从队列中取出消息并按间隔发送"""
-    logger.info("消息发送任务已启动，等待队列中的消息...")
-    while True:
+def discard_task(task: MessageTask, reason: str) -> None:
+    """丢弃未能入队的任务：停止后台下载、释放媒体、归还账号负载并删除任务日志记录"""
+    metrics.inc('tguserbot_tasks_dropped_total', reason=reason)
+    finish_trace(task.trace, 'dropped')
+    account_load.release(task.client_index)
+    if task.media_ready and not task.media_ready.done():
+        task.media_ready.cancel()
+    task.release_media()
+    if task_journal:
+        task_journal.complete(task, False)
+
+# Telegram 单个相册最多 10 个文件
+ALBUM_MAX_PARTS = 10
+
+class AlbumBuffer:
+    """同一 grouped_id 的相册在收集窗口内已到达的各部分（只接收认领账号收到的部分）"""
+    def __init__(self, owner, listener_name: str, chat_id: int, client_index: int, user_type: str, target: TargetConfig, received_at: float, trace: Optional[MessageTrace] = None):
+        self.owner = owner
+        self.received_at = received_at
+        self.trace = trace
+        self.target = target
+        self.listener_name = listener_name
+        self.chat_id = chat_id
+        self.client_index = client_index
+        self.user_type = user_type
+        self.events: List = []
+        self.dedup_keys: List[int] = []
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+
+class AlbumCollector:
+    """按 grouped_id 短暂缓冲相册各部分，窗口内无新部分到达（或已满 10 个）时合并为一条任务"""
+    def __init__(self, window: float):
+        self.window = window
+        self._buffers: Dict[int, AlbumBuffer] = {}
+        self._flushing: Set[asyncio.Task] = set()
+
+    def get(self, album_key: int) -> Optional[AlbumBuffer]:
+        return self._buffers.get(album_key)
+
+    def pending(self) -> int:
+        """收集中或正在下载合并的相册数"""
+        return len(self._buffers) + len(self._flushing)
+
+    def open(self, album_key: int, buffer: AlbumBuffer) -> None:
+        self._buffers[album_key] = buffer
+
+    def add_part(self, album_key: int, event, dedup_keys: List[int]) -> None:
+        buffer = self._buffers[album_key]
+        buffer.events.append(event)
+        for key in dedup_keys:
+            if key not in buffer.dedup_keys:
+                buffer.dedup_keys.append(key)
+        if buffer.flush_handle:
+            buffer.flush_handle.cancel()
+        loop = asyncio.get_running_loop()
+        if len(buffer.events) >= ALBUM_MAX_PARTS:
+            buffer.flush_handle = loop.call_soon(self._flush, album_key)
+        else:
+            buffer.flush_handle = loop.call_later(self.window, self._flush, album_key)
+
+    def _flush(self, album_key: int) -> None:
+        buffer = self._buffers.pop(album_key, None)
+        if buffer is None:
+            return
+        task = asyncio.create_task(flush_album(buffer))
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+async def download_album(task: MessageTask, parts: List, all_captions: List[str]) -> int:
+    """由下载池并发下载相册各部分并填入任务，下载失败的部分连同其文案一起略去；返回成功的文件数"""
+    results = await asyncio.gather(*(download_pool.download(e, make_part_keys(e)) for e in parts))
+    media = []
+    captions = []
+    for caption, payload in zip(all_captions, results):
+        if payload is None:
+            continue
+        media.append(payload)
+        captions.append(caption)
+    # 全部下载失败时保留入队时的文字（若也没有文字，发送时跳过）
+    if media:
+        task.media = media
+        task.captions = captions
+        task.msg_text = next((c for c in captions if c), '')
+    return len(media)
+
+async def flush_album(buffer: AlbumBuffer) -> None:
+    """相册收集完成后立即作为一条任务入队，各部分由下载池并发下载，发送时由 send_file 一次发送"""
+    try:
+        if buffer.trace:
+            buffer.trace.mark('album_flushed')
+        events = sorted(buffer.events, key=lambda e: e.message.id)
+        all_captions = [buffer.target.apply_replacements(e.message.message or '') for e in events]
+
+        async def load_album(task: MessageTask) -> None:
+            downloaded = await download_album(task, events, all_captions)
+            message_logger.info("🖼️ [%s] 相册下载完成: %s 部分，成功 %s 个文件，群组 %s", buffer.listener_name, len(events), downloaded, buffer.chat_id)
+
+        message_logger.info("🖼️ [%s] 相册收集完成: %s 部分，群组 %s", buffer.listener_name, len(events), buffer.chat_id)
+        await enqueue_target_message(
+            event=events[0],
+            listener_name=buffer.listener_name,
+            chat_id=buffer.chat_id,
+            msg_text=next((c for c in all_captions if c), ''),
+            media=None,
+            user_type=buffer.user_type,
+            dedup_keys=buffer.dedup_keys,
+            client_index=buffer.client_index,
+            captions=all_captions,
+            received_at=buffer.received_at,
+            trace=buffer.trace,
+            media_loader=load_album,
+            priority=message_priority([e.message for e in events]),
+            media_source={'account': buffer.listener_name, 'message_ids': [e.message.id for e in events], 'album': True}
+        )
+    except Exception as e:
+        logger.error(f"❌ 处理相册时发生错误: {str(e)}", exc_info=True)
+        finish_trace(buffer.trace, 'error')
+        account_load.release(buffer.client_index)
+
+class TokenBucket:
+    """令牌桶：rate 为每秒补充的令牌数，capacity 为突发上限"""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class RateLimiter:
+    """按 (账号, 群组) 的自适应令牌桶限速，并根据 FloodWait 让账号进入冷却
+    
+    收到 FloodWaitError 时账号整体停放到 seconds 之后，对应令牌桶速率减半；
+    之后每次成功发送按基础速率的 1/10 逐步恢复。SlowModeWaitError 只冷却该群组。
+    """
+    def __init__(self, per_minute: float, burst: float, padding: float):
+        self.base_rate = per_minute / 60.0
+        self.burst = burst
+        self.padding = padding
+        self._buckets: Dict[Tuple[int, int], TokenBucket] = {}
+        self._account_cooldown: Dict[int, float] = {}
+        self._chat_cooldown: Dict[Tuple[int, int], float] = {}
+        self.flood_waits: Dict[int, int] = defaultdict(int)
+
+    def reconfigure(self, per_minute: float, burst: float, padding: float) -> None:
+        """热加载新的限速参数：已降速的令牌桶按比例换算，保留当前的冷却状态"""
+        old_rate = self.base_rate
+        self.base_rate = per_minute / 60.0
+        self.burst = burst
+        self.padding = padding
+        for bucket in self._buckets.values():
+            bucket.rate = self.base_rate if bucket.rate >= old_rate else bucket.rate * self.base_rate / old_rate
+            bucket.capacity = burst
+            bucket.tokens = min(bucket.tokens, burst)
+
+    def _bucket(self, index: int, chat_id: int) -> TokenBucket:
+        key = (index, chat_id)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.base_rate, self.burst)
+        return bucket
+
+    def cooldown_remaining(self, index: int, now: Optional[float] = None) -> float:
+        if now is None:
+            now = time.monotonic()
+        return max(0.0, self._account_cooldown.get(index, 0.0) - now)
+
+    def is_parked(self, index: int) -> bool:
+        return self.cooldown_remaining(index) > 0
+
+    def wait_time(self, index: int, chat_id: int) -> float:
+        """该账号距离可以向该群组发送还需等待的秒数（0 表示有余量）"""
+        now = time.monotonic()
+        chat_wait = max(0.0, self._chat_cooldown.get((index, chat_id), 0.0) - now)
+        return max(self.cooldown_remaining(index, now), chat_wait, self._bucket(index, chat_id).wait_time(now))
+
+    def has_budget(self, index: int, chat_id: int) -> bool:
+        return self.wait_time(index, chat_id) == 0
+
+    def consume(self, index: int, chat_id: int) -> None:
+        bucket = self._bucket(index, chat_id)
+        bucket.refill(time.monotonic())
+        bucket.tokens = max(0.0, bucket.tokens - 1)
+
+    def on_success(self, index: int, chat_id: int) -> None:
+        bucket = self._bucket(index, chat_id)
+        if bucket.rate < self.base_rate:
+            bucket.rate = min(self.base_rate, bucket.rate + self.base_rate / 10)
+
+    def on_flood_wait(self, index: int, chat_id: int, seconds: float, chat_only: bool = False) -> None:
+        now = time.monotonic()
+        until = now + seconds + self.padding
+        if chat_only:
+            self._chat_cooldown[(index, chat_id)] = until
+        else:
+            self._account_cooldown[index] = max(self._account_cooldown.get(index, 0.0), until)
+            self.flood_waits[index] += 1
+        bucket = self._bucket(index, chat_id)
+        bucket.refill(now)
+        bucket.rate = max(self.base_rate / 16, bucket.rate / 2)
+        bucket.tokens = 0.0
+
+    def prune(self) -> None:
+        """丢弃已回满且未被降速的令牌桶以及已过期的冷却记录"""
+        now = time.monotonic()
+        for key, bucket in list(self._buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity and bucket.rate >= self.base_rate:
+                del self._buckets[key]
+        for index, until in list(self._account_cooldown.items()):
+            if until <= now:
+                del self._account_cooldown[index]
+        for key, until in list(self._chat_cooldown.items()):
+            if until <= now:
+                del self._chat_cooldown[key]
+
+    def snapshot(self) -> Dict[int, dict]:
+        """每个账号的限速余量：冷却剩余、FloodWait 次数、受限群组数和最低令牌数"""
+        now = time.monotonic()
+        result = {}
+        for index in range(len(clients)):
+            buckets = [b for (i, _), b in self._buckets.items() if i == index]
+            for bucket in buckets:
+                bucket.refill(now)
+            result[index] = {
+                'cooldown': self.cooldown_remaining(index, now),
+                'flood_waits': self.flood_waits.get(index, 0),
+                'throttled_chats': sum(1 for b in buckets if b.tokens < 1),
+                'min_tokens': min((b.tokens for b in buckets), default=self.burst),
+            }
+        return result
+
+async def deliver_task(task: MessageTask) -> bool:
+    """发送一条任务：优先使用指定账号，失败或被限速时改用仍有余量的其他账号；返回是否已发送"""
+    if not task.media and not task.msg_text:
+        logger.warning(f"任务没有可发送的内容（媒体下载失败且没有文字），跳过: 群组 {task.chat_id}")
+        return False
+    async with message_dedup_lock:
+        if task.dedup_keys and is_duplicate(task.dedup_keys, sent_messages):
+            metrics.inc('tguserbot_dedup_checks_total', stage='send', result='hit')
+            message_logger.info("⏭️ 跳过重复发送: %s", task.dedup_keys)
+            return False
+    metrics.inc('tguserbot_dedup_checks_total', stage='send', result='miss')
+    
+    # 失活的账号不参与发送（全部失活时仍逐个尝试）
+    usable = account_health.usable()
+    candidates = ([task.client_index] if task.client_index in usable else []) + [
+        i for i in usable if i != task.client_index
+    ]
+    tried: Set[int] = set()
+    sent = False
+    last_error = None
+    
+    while not sent:
+        remaining = [i for i in candidates if i not in tried]
+        if not remaining:
+            break
+        idx = next((i for i in remaining if rate_limiter.has_budget(i, task.chat_id)), None)
+        if idx is None:
+            wait = min(rate_limiter.wait_time(i, task.chat_id) for i in remaining)
+            if wait > max_flood_wait:
+                logger.error(f"✗ 所有可用账号的限速冷却均超过 {max_flood_wait:.0f} 秒（最短 {wait:.0f} 秒），放弃发送到群组 {task.chat_id}")
+                return False
+            message_logger.info("⏳ 所有可用账号均在限速冷却中，%.1f 秒后重试发送到群组 %s", wait, task.chat_id)
+            await asyncio.sleep(wait)
+            if task.trace:
+                task.trace.mark('rate_limit_waited')
+            continue
+        
+        tried.add(idx)
+        send_client_name = active_accounts[idx]['name']
+        await send_scheduler.pace(idx)
+        if task.trace:
+            task.trace.mark(f'paced:{send_client_name}')
+        rate_limiter.consume(idx, task.chat_id)
         try:
-            task = await message_queue.get()
-            
-            if task.client_index is None:
-                logger.error("任务未指定发送账号，跳过")
-                message_queue.task_done()
+            message_logger.info("开始使用客户端 %s 发送消息到群组 %s...", send_client_name, task.chat_id)
+            if task.trace:
+                task.trace.mark(f'send_start:{send_client_name}')
+            send_started = time.monotonic()
+            await send_task_message(idx, task)
+            account_load.record_send(idx, time.monotonic() - send_started, True)
+            task.sent_by = send_client_name
+            rate_limiter.on_success(idx, task.chat_id)
+            metrics.inc('tguserbot_send_total', account=send_client_name, result='success')
+            now = time.monotonic()
+            if task.enqueued_at is not None:
+                metrics.observe('tguserbot_enqueue_to_send_seconds', now - task.enqueued_at)
+            if task.received_at is not None:
+                metrics.observe('tguserbot_receive_to_send_seconds', now - task.received_at)
+            message_logger.info("✓ [%s] 已复制%s消息%s到群组 %s: %.100s...", send_client_name, task.user_type, "（含媒体）" if task.media else "", task.chat_id, task.msg_text)
+            sent = True
+        except FloodWaitError as e:
+            last_error = e
+            account_load.record_send(idx, 0.0, False)
+            rate_limiter.on_flood_wait(idx, task.chat_id, e.seconds)
+            metrics.inc('tguserbot_send_total', account=send_client_name, result='flood_wait')
+            logger.warning(f"⏸️ [{send_client_name}] 触发 FloodWait，账号冷却 {e.seconds} 秒")
+        except SlowModeWaitError as e:
+            last_error = e
+            account_load.record_send(idx, 0.0, False)
+            rate_limiter.on_flood_wait(idx, task.chat_id, e.seconds, chat_only=True)
+            metrics.inc('tguserbot_send_total', account=send_client_name, result='slow_mode')
+            logger.warning(f"⏸️ [{send_client_name}] 群组 {task.chat_id} 慢速模式，需等待 {e.seconds} 秒")
+        except Exception as e:
+            last_error = e
+            account_load.record_send(idx, 0.0, False)
+            metrics.inc('tguserbot_send_total', account=send_client_name, result='failure')
+            logger.error(f"✗ [{send_client_name}] 发送失败: {str(e)}")
+    
+    if not sent and last_error:
+        logger.error(f"✗ 所有账号均发送失败，最后错误: {str(last_error)}")
+    elif sent and task.dedup_keys:
+        async with message_dedup_lock:
+            mark_keys(task.dedup_keys, sent_messages)
+        if coordinator:
+            await coordinator.notify('sent', keys=task.dedup_keys)
+    return sent
+
+class TaskJournal:
+    """基于 SQLite（WAL 模式）的任务日志
+    
+    入队时记录任务元数据；媒体下载完成前记录原消息位置（重放时重新下载），完成后改为媒体落盘路径；
+    发送结束后删除该任务并写入已发送去重键；
+    写操作先进入内存批次，由后台任务每 journal_flush_interval 秒在线程中合并提交一次。
+    重启时重放未完成的任务并载入近期已发送的去重键，崩溃最多丢失一个提交间隔内的状态。
+    """
+    def __init__(self, path: str, flush_interval: float):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._conn: Optional[sqlite3.Connection] = None
+        self._ops: List[Tuple[str, tuple]] = []
+        self._committing: Optional[asyncio.Future] = None
+
+    def open(self) -> None:
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "id TEXT PRIMARY KEY, created_at REAL, chat_id INTEGER, account TEXT, "
+                "msg_text TEXT, user_type TEXT, media TEXT, captions TEXT, dedup_keys TEXT)"
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS sent_keys (key INTEGER PRIMARY KEY, sent_at REAL)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS chat_progress ("
+                "account TEXT, chat_id INTEGER, last_id INTEGER, updated_at REAL, PRIMARY KEY (account, chat_id))"
+            )
+
+    def load_sent_keys(self, since: float) -> List[int]:
+        with self._conn:
+            self._conn.execute("DELETE FROM sent_keys WHERE sent_at < ?", (since,))
+        return [row[0] for row in self._conn.execute("SELECT key FROM sent_keys")]
+
+    def load_progress(self, since: float) -> List[Tuple[str, int, int]]:
+        """载入补抓进度，超过 since 未更新的群组视为已不活跃并删除"""
+        with self._conn:
+            self._conn.execute("DELETE FROM chat_progress WHERE updated_at < ?", (since,))
+        return self._conn.execute("SELECT account, chat_id, last_id FROM chat_progress").fetchall()
+
+    def load_pending(self) -> List[dict]:
+        rows = self._conn.execute(
+            "SELECT id, created_at, chat_id, account, msg_text, user_type, media, captions, dedup_keys "
+            "FROM tasks ORDER BY created_at"
+        ).fetchall()
+        result = []
+        for row in rows:
+            result.append({
+                'id': row[0],
+                'created_at': row[1],
+                'chat_id': row[2],
+                'account': row[3],
+                'msg_text': row[4],
+                'user_type': row[5],
+                'media': json.loads(row[6]) if row[6] else None,
+                'captions': json.loads(row[7]) if row[7] else None,
+                'dedup_keys': json.loads(row[8]) if row[8] else [],
+            })
+        return result
+
+    async def record_task(self, task: MessageTask) -> None:
+        """记录新入队的任务；内存中的媒体先写入 spool 文件以便重启后恢复"""
+        for payload in task.media_items:
+            if not payload.path:
+                await asyncio.to_thread(payload.persist)
+        if task.media is None:
+            source = task.media_source
+            media = {'album': source['album'], 'items': [], 'source': source} if source else None
+        else:
+            media = {
+                'album': isinstance(task.media, list),
+                'items': [
+                    {'path': m.path, 'filename': m.filename, 'force_document': m.force_document, 'source_key': m.source_key}
+                    for m in task.media_items
+                ],
+            }
+        account = active_accounts[task.client_index]['name'] if task.client_index is not None else None
+        self._ops.append((
+            "INSERT OR REPLACE INTO tasks (id, created_at, chat_id, account, msg_text, user_type, media, captions, dedup_keys) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (task.task_id, task.created_at, task.chat_id, account, task.msg_text, task.user_type,
+             json.dumps(media) if media else None,
+             json.dumps(task.captions, ensure_ascii=False) if task.captions else None,
+             json.dumps(task.dedup_keys)),
+        ))
+
+    def complete(self, task: MessageTask, sent: bool) -> None:
+        self._ops.append(("DELETE FROM tasks WHERE id = ?", (task.task_id,)))
+        if sent:
+            now = time.time()
+            for key in task.dedup_keys:
+                self._ops.append(("INSERT OR REPLACE INTO sent_keys (key, sent_at) VALUES (?, ?)", (key, now)))
+
+    def record_progress(self, account: str, chat_id: int, message_id: int) -> None:
+        self._ops.append((
+            "INSERT INTO chat_progress (account, chat_id, last_id, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (account, chat_id) DO UPDATE SET last_id = MAX(last_id, excluded.last_id), updated_at = excluded.updated_at",
+            (account, chat_id, message_id, time.time()),
+        ))
+
+    def prune_sent_keys(self, since: float) -> None:
+        self._ops.append(("DELETE FROM sent_keys WHERE sent_at < ?", (since,)))
+
+    def _commit(self, ops: List[Tuple[str, tuple]]) -> None:
+        with self._conn:
+            for sql, params in ops:
+                self._conn.execute(sql, params)
+
+    async def flush(self) -> None:
+        """提交当前批次；同一时刻只有一个批次在线程中提交，调用方被取消时已取出的批次仍会提交完成"""
+        if self._committing and not self._committing.done():
+            await asyncio.wait([self._committing])
+        if not self._ops:
+            return
+        ops, self._ops = self._ops, []
+        self._committing = asyncio.ensure_future(asyncio.to_thread(self._commit, ops))
+        await asyncio.shield(self._committing)
+
+    async def run(self) -> None:
+        """后台批量提交"""
+        while True:
+            try:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"任务日志提交失败: {str(e)}", exc_info=True)
+
+    async def close(self) -> None:
+        if self._conn is None:
+            return
+        try:
+            await self.flush()
+        finally:
+            # flush 失败或被取消时也要等正在线程中提交的批次结束后再关闭连接
+            if self._committing and not self._committing.done():
+                await asyncio.wait([self._committing])
+            self._conn.close()
+            self._conn = None
+
+def restore_task(row: dict) -> MessageTask:
+    """由任务日志中的记录重建任务；原发送账号未上线时重新分配"""
+    items = []
+    for item in (row['media'] or {}).get('items', []):
+        if item['path'] and os.path.exists(item['path']):
+            items.append(MediaPayload(None, item['filename'], item['force_document'], item['source_key'], path=item['path']))
+        else:
+            logger.warning(f"任务 {row['id']} 的媒体文件已丢失: {item['path']}")
+    if not items:
+        media = None
+    elif row['media'].get('album'):
+        media = items
+    else:
+        media = items[0]
+    names = [a['name'] for a in active_accounts]
+    if row['account'] in names and account_health.is_healthy(names.index(row['account'])):
+        client_index = names.index(row['account'])
+        account_load.reserve(client_index)
+    else:
+        client_index = pick_sender_index(row['chat_id'])
+    task = MessageTask(
+        chat_id=row['chat_id'],
+        msg_text=row['msg_text'],
+        media=media,
+        user_type=row['user_type'],
+        client_index=client_index,
+        dedup_keys=row['dedup_keys'],
+        captions=row['captions'] if isinstance(media, list) else None,
+    )
+    task.task_id = row['id']
+    task.created_at = row['created_at']
+    task.priority = media_priority([m.size for m in task.media_items])
+    source = (row['media'] or {}).get('source')
+    if source:
+        # 重启前媒体尚未下载完成：按原消息位置重新下载
+        task.media_source = source
+        task.captions = row['captions']
+        task.priority = PRIORITY_MEDIA
+        task.media_ready = asyncio.create_task(load_task_media(task, lambda t: refetch_task_media(t, source)))
+    return task
+
+async def refetch_task_media(task: MessageTask, source: dict) -> None:
+    """按任务日志中记录的位置重新获取原消息并下载其媒体：优先用当初收到消息的账号
+    
+    超级群组/频道中各账号看到的消息 ID 相同，该账号不在线时可改用其他账号；普通群组只能用原账号。
+    """
+    names = [a['name'] for a in active_accounts]
+    indices = [names.index(source['account'])] if source['account'] in names else []
+    if task.chat_id <= -1000000000000:
+        indices += [i for i in account_health.usable() if i not in indices]
+    last_error = None
+    for index in indices:
+        client = clients[index]
+        try:
+            messages = await client.get_messages(task.chat_id, ids=source['message_ids'])
+        except Exception as e:
+            last_error = e
+            continue
+        parts = []
+        captions = []
+        for position, message in enumerate(messages):
+            if message is None or not message.media:
                 continue
-            
-            async with message_dedup_lock:
-                if task.dedup_keys and is_duplicate(task.dedup_keys, sent_messages):
-                    logger.info(f"⏭️ 跳过重复发送: {task.dedup_keys}")
-                    message_queue.task_done()
-                    continue
-            
-            jitter = random.uniform(0, send_jitter)
-            delay = send_interval + jitter
-            logger.info(f"等待 {delay:.2f} 秒后发送（间隔: {send_interval}秒，抖动: {jitter:.2f}秒）...")
+            event = events.NewMessage.Event(message)
+            event._set_client(client)
+            parts.append(event)
+            captions.append(task.captions[position] if task.captions and position < len(task.captions) else '')
+        if not parts:
+            logger.warning(f"任务 {task.task_id} 的原消息已不存在或不含媒体，仅发送文本")
+            return
+        if source['album']:
+            downloaded = await download_album(task, parts, captions)
+        else:
+            task.media = await download_pool.download(parts[0], make_part_keys(parts[0]))
+            downloaded = 1 if task.media else 0
+        logger.info(f"📒 任务 {task.task_id} 的媒体已重新下载: {downloaded}/{len(parts)} 个文件（经由 {active_accounts[index]['name']}）")
+        return
+    raise RuntimeError(f"无法重新获取原消息: {str(last_error) if last_error else '收到该消息的账号不在线'}")
+
+async def replay_journal() -> None:
+    """启动时载入已发送去重键并重放未完成的任务"""
+    sent_keys = task_journal.load_sent_keys(time.time() - dedup_ttl)
+    pending = task_journal.load_pending()
+    async with message_dedup_lock:
+        mark_keys(sent_keys, sent_messages)
+        for row in pending:
+            mark_keys(row['dedup_keys'], claimed_messages)
+    restored = 0
+    for row in pending:
+        task = restore_task(row)
+        if not task.msg_text and not task.media and not task.media_source:
+            task_journal.complete(task, False)
+            continue
+        # 重放发生在 worker 启动前，不受队列容量限制；过时的任务由 worker 取出时丢弃
+        await send_scheduler.put(task, force=True)
+        restored += 1
+    logger.info(f"📒 任务日志: 载入 {len(sent_keys)} 个已发送去重键，重放 {restored} 条未完成任务")
+
+def journal_spool_paths() -> Set[str]:
+    """任务日志中仍被引用的落盘媒体路径（启动清理时保留）"""
+    paths = set()
+    for row in task_journal.load_pending():
+        for item in (row['media'] or {}).get('items', []):
+            if item['path']:
+                paths.add(os.path.abspath(item['path']))
+    return paths
+
+class SendScheduler:
+    """按账号并行发送的调度器
+    
+    每个账号一个 worker；发送节奏（send_interval + 抖动）按实际发送的账号控制，见 pace；
+    同一群组的任务按入队顺序逐条发送（前一条完成前后一条不会被取出）；
+    worker 在各群组之间轮转取任务，繁忙群组不会饿死安静的群组；轮转时优先取队首优先级更高的群组。
+    队首媒体仍在后台下载的群组暂不取出，下载完成后再唤醒 worker，慢下载不会挡住该账号其他群组的发送。
+    排队任务数达到 capacity 时 put 等待空位，超时返回 False 由调用方丢弃任务。
+    """
+    def __init__(self, capacity: int = 0, full_timeout: float = 0.0, max_age: float = 0.0):
+        self.capacity = capacity
+        self.full_timeout = full_timeout
+        self.max_age = max_age
+        self._space = asyncio.Event()
+        self._chats: 'OrderedDict[int, deque]' = OrderedDict()
+        self._busy_chats: Set[int] = set()
+        self._wakeups: Dict[int, asyncio.Event] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._next_send_at: Dict[int, float] = {}
+        self._pending = 0
+        self._unfinished = 0
+        self._all_done = asyncio.Event()
+        self._all_done.set()
+
+    def qsize(self) -> int:
+        return self._pending
+
+    def empty(self) -> bool:
+        return self._pending == 0
+
+    def full(self) -> bool:
+        return bool(self.capacity) and self._pending >= self.capacity
+
+    def reconfigure(self, capacity: int, full_timeout: float, max_age: float) -> None:
+        self.capacity = capacity
+        self.full_timeout = full_timeout
+        self.max_age = max_age
+        # 容量变大时让等待空位的 put 重新检查
+        self._space.set()
+
+    async def _wait_for_space(self) -> bool:
+        deadline = time.monotonic() + self.full_timeout
+        while self.full():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self._space.clear()
+            try:
+                await asyncio.wait_for(self._space.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def put(self, task: MessageTask, force: bool = False) -> bool:
+        """入队；队列已满且等待超时时返回 False。force 为 True 时不受容量限制（用于重放任务日志）"""
+        if not force and self.full() and not await self._wait_for_space():
+            return False
+        chat_queue = self._chats.get(task.chat_id)
+        if chat_queue is None:
+            chat_queue = self._chats[task.chat_id] = deque()
+        chat_queue.append(task)
+        if task.media_ready and not task.media_ready.done():
+            task.media_ready.add_done_callback(lambda _: self._wake(task.client_index))
+        self._pending += 1
+        self._unfinished += 1
+        self._all_done.clear()
+        if len(chat_queue) == 1:
+            self._wake(task.client_index)
+        return True
+
+    async def join(self) -> None:
+        await self._all_done.wait()
+
+    def start_worker(self, index: int) -> None:
+        if index in self._workers:
+            return
+        self._wakeups.setdefault(index, asyncio.Event())
+        self._workers[index] = asyncio.create_task(self._worker(index))
+
+    async def stop(self) -> None:
+        workers = list(self._workers.values())
+        self._workers.clear()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    def _wake(self, index: int) -> None:
+        event = self._wakeups.get(index)
+        if event:
+            event.set()
+
+    def _take(self, index: int) -> Optional[MessageTask]:
+        """在队首属于该账号、未在发送中且媒体已就绪的群组里，按轮转顺序取出优先级最高的队首任务
+        
+        同一群组内始终按入队顺序发送；等待超过 priority_aging 秒的队首视为最高优先级，大媒体不会被持续的文字消息饿死。
+        """
+        best_chat = None
+        best_priority = None
+        aged_before = time.monotonic() - priority_aging
+        for chat_id, chat_queue in self._chats.items():
+            head = chat_queue[0]
+            if chat_id in self._busy_chats or head.client_index != index:
+                continue
+            if head.media_ready and not head.media_ready.done():
+                continue
+            priority = head.priority
+            if head.enqueued_at is not None and head.enqueued_at < aged_before:
+                priority = PRIORITY_TEXT
+            if best_priority is None or priority < best_priority:
+                best_chat, best_priority = chat_id, priority
+                if priority == PRIORITY_TEXT:
+                    break
+        if best_chat is None:
+            return None
+        chat_queue = self._chats[best_chat]
+        task = chat_queue.popleft()
+        if chat_queue:
+            self._chats.move_to_end(best_chat)
+        else:
+            del self._chats[best_chat]
+        self._busy_chats.add(best_chat)
+        self._pending -= 1
+        self._space.set()
+        return task
+
+    def _is_stale(self, task: MessageTask) -> bool:
+        return self.max_age > 0 and time.time() - task.created_at > self.max_age
+
+    def _finish(self, task: MessageTask, sent: Optional[bool], outcome: Optional[str] = None) -> None:
+        """sent 为 None 表示任务被中断（如退出时取消），保留其日志记录与落盘媒体供下次重放"""
+        if outcome is None:
+            outcome = 'abandoned' if sent is None else ('sent' if sent else 'failed')
+        finish_trace(task.trace, outcome, task.sent_by)
+        account_load.release(task.client_index)
+        if task.media_ready and not task.media_ready.done():
+            task.media_ready.cancel()
+        if sent is None:
+            task.release_media(keep_files=task_journal is not None)
+        else:
+            task.release_media()
+            if task_journal:
+                task_journal.complete(task, sent)
+        self._busy_chats.discard(task.chat_id)
+        chat_queue = self._chats.get(task.chat_id)
+        if chat_queue:
+            self._wake(chat_queue[0].client_index)
+        self._unfinished -= 1
+        if self._unfinished == 0:
+            self._all_done.set()
+
+    async def pace(self, index: int) -> None:
+        """按实际发送的账号控制节奏：回退发送与该账号自己的 worker 共用同一个发送时间表
+        
+        先预留发送时刻再等待，同一账号上并发的发送依次排开，不会同时放行。
+        """
+        jitter = random.uniform(0, send_jitter)
+        now = time.monotonic()
+        send_at = max(now, self._next_send_at.get(index, now))
+        self._next_send_at[index] = send_at + send_interval + jitter
+        delay = send_at - now
+        if delay > 0:
+            message_logger.info("[%s] 等待 %.2f 秒后发送（间隔: %s秒，抖动: %.2f秒）...", active_accounts[index]['name'], delay, send_interval, jitter)
             await asyncio.sleep(delay)
-            
-            indices_to_try = [task.client_index] + [
-                i for i in range(len(clients)) if i != task.client_index
-            ]
-            sent = False
-            last_error = None
-            
-            for idx in indices_to_try:
-                send_client = clients[idx]
-                send_client_name = active_accounts[idx]['name']
+
+    async def _worker(self, index: int) -> None:
+        name = active_accounts[index]['name']
+        wakeup = self._wakeups[index]
+        logger.info(f"[{name}] 发送 worker 已启动，等待队列中的消息...")
+        while True:
+            try:
+                task = self._take(index)
+                if task is None:
+                    wakeup.clear()
+                    await wakeup.wait()
+                    continue
+                if self._is_stale(task):
+                    metrics.inc('tguserbot_tasks_dropped_total', reason='stale')
+                    message_logger.warning("🗑️ [%s] 丢弃过时任务: 群组 %s，已排队 %.0f 秒（上限 %s 秒）", name, task.chat_id, time.time() - task.created_at, self.max_age)
+                    self._finish(task, False, 'stale')
+                    continue
+                sent = None
+                if task.trace:
+                    task.trace.mark('dequeued')
                 try:
-                    logger.info(f"开始使用客户端 {send_client_name} 发送消息到群组 {task.chat_id}...")
-                    await send_task_message(send_client, task)
-                    if task.media:
-                        logger.info(f"✓ [{send_client_name}] 已复制{task.user_type}消息（含媒体）到群组 {task.chat_id}: {task.msg_text[:100]}...")
-                    else:
-                        logger.info(f"✓ [{send_client_name}] 已复制{task.user_type}消息到群组 {task.chat_id}: {task.msg_text[:100]}...")
-                    sent = True
-                    break
+                    if task.media_ready:
+                        # _take 只取出媒体已下载完成的任务，这里取回下载结果
+                        await task.media_ready
+                        if task.trace:
+                            task.trace.mark('media_ready')
+                    sent = await deliver_task(task)
+                except asyncio.CancelledError:
+                    raise
                 except Exception as e:
-                    last_error = e
-                    logger.error(f"✗ [{send_client_name}] 发送失败: {str(e)}")
-            
-            if not sent and last_error:
-                logger.error(f"✗ 所有账号均发送失败，最后错误: {str(last_error)}")
-            elif sent and task.dedup_keys:
-                async with message_dedup_lock:
-                    mark_keys(task.dedup_keys, sent_messages)
-            
-            message_queue.task_done()
-            logger.info(f"消息发送完成，当前队列剩余: {message_queue.qsize()} 条")
-            
+                    sent = False
+                    logger.error(f"[{name}] 发送任务时发生错误: {str(e)}", exc_info=True)
+                finally:
+                    self._finish(task, sent)
+                message_logger.info("[%s] 消息发送完成，当前队列剩余: %s 条", name, self.qsize())
+            except asyncio.CancelledError:
+                logger.info(f"[{name}] 发送 worker 已取消")
+                break
+            except Exception as e:
+                logger.error(f"[{name}] 发送 worker 发生错误: {str(e)}", exc_info=True)
+                await asyncio.sleep(1)
+
+async def collect_album_part(event, album_key: int, dedup_keys: List[int], listener_name: str, user_type: str, target: TargetConfig, received_at: float, trace: Optional[MessageTrace] = None) -> None:
+    """相册部分：首个到达的部分认领整个相册，之后认领账号收到的其余部分并入同一缓冲"""
+    async with message_dedup_lock:
+        buffer = album_collector.get(album_key)
+        if buffer is not None:
+            if buffer.owner is not event.client:
+                download_pool.add_source(make_part_keys(event), event)
+                return
+            mark_keys(dedup_keys, claimed_messages)
+            album_collector.add_part(album_key, event, dedup_keys)
+            message_logger.info("🖼️ [%s] 相册新增部分 - 消息ID: %s（已收集 %s 个）", listener_name, event.message.id, len(buffer.events))
+            return
+        client_index = await claim_message(dedup_keys, event.chat_id, target.distribution_strategy)
+        if client_index is None:
+            metrics.inc('tguserbot_dedup_checks_total', stage='claim', result='hit')
+            message_logger.info("⏭️ [%s] 相册已认领/已发送，跳过重复: %s", listener_name, dedup_keys)
+            download_pool.add_source(make_part_keys(event), event)
+            return
+        if trace:
+            trace.mark('claimed')
+        album_collector.open(album_key, AlbumBuffer(event.client, listener_name, event.chat_id, client_index, user_type, target, received_at, trace))
+        album_collector.add_part(album_key, event, dedup_keys)
+    message_logger.info("🖼️ [%s] 开始收集相册 - 消息ID: %s，窗口 %s 秒", listener_name, event.message.id, album_collector.window)
+
+def build_message_event() -> events.NewMessage:
+    """构造带廉价过滤条件的 NewMessage 事件：所有目标 ID 均已解析时按 from_users 过滤，配置了白名单时按 chats 过滤
+    
+    过滤在 Telethon 事件构建阶段完成，不匹配的消息不会进入 handler，不发起 RPC，也不占用去重锁。
+    """
+    all_resolved = all(t.user_id is not None for t in targets)
+    return events.NewMessage(
+        incoming=True,
+        from_users=list(targets_by_id) if all_resolved else None,
+        chats=list(chat_allowlist) if chat_allowlist is not None else None,
+    )
+
+def register_message_handler(client: TelegramClient) -> None:
+    client.remove_event_handler(handler)
+    client.add_event_handler(handler, build_message_event())
+
+async def resolve_target(target: TargetConfig) -> bool:
+    """用任一在线账号把目标用户名解析为用户 ID，ID 发生变化时返回 True"""
+    last_error = None
+    for index, client in enumerate(clients):
+        try:
+            entity = await client.get_entity(target.username)
+        except Exception as e:
+            last_error = e
+            continue
+        changed = entity.id != target.user_id
+        target.user_id = entity.id
+        target.is_bot = bool(getattr(entity, 'bot', False))
+        startup_cache.put_target(target)
+        if changed:
+            logger.info(f"🎯 目标用户 @{target.username} 已解析为 ID {target.user_id}（机器人: {target.is_bot}，经由 {active_accounts[index]['name']}）")
+        return changed
+    logger.warning(f"⚠️ 无法解析目标用户 @{target.username}，将在 handler 中按用户名匹配: {str(last_error)}")
+    return False
+
+async def resolve_targets(skip_resolved: bool = False) -> bool:
+    """解析全部目标并重建 sender_id → 目标 的分派表，有任一 ID 变化时返回 True
+    
+    skip_resolved 为 True 时跳过已有 ID（如来自启动缓存）的目标。
+    """
+    global targets_by_id
+    changed = False
+    for target in targets:
+        if skip_resolved and target.user_id is not None:
+            continue
+        if await resolve_target(target):
+            changed = True
+    targets_by_id = {t.user_id: t for t in targets if t.user_id is not None}
+    return changed
+
+def load_cached_targets() -> int:
+    """用启动缓存中的实体填充目标 ID，返回命中数"""
+    hits = 0
+    for target in targets:
+        entry = startup_cache.get_target(target.username)
+        if entry is None:
+            continue
+        target.user_id = entry['id']
+        target.is_bot = entry['is_bot']
+        hits += 1
+        logger.info(f"🎯 目标用户 @{target.username} 使用缓存 ID {target.user_id}（机器人: {target.is_bot}）")
+    return hits
+
+async def target_refresh_loop(first_delay: Optional[float] = None):
+    """定期重新解析目标用户，ID 变化时为所有账号重新注册监听；first_delay 为首次刷新前的等待秒数"""
+    delay = target_refresh_interval if first_delay is None else first_delay
+    while True:
+        try:
+            await asyncio.sleep(delay)
+            delay = target_refresh_interval
+            changed = await resolve_targets()
+            startup_cache.save()
+            if changed:
+                for client in clients:
+                    register_message_handler(client)
+                logger.info("目标用户 ID 已变化，已为所有账号重新注册消息监听")
         except asyncio.CancelledError:
-            logger.info("消息发送任务已取消")
             break
         except Exception as e:
-            logger.error(f"消息发送任务发生错误: {str(e)}", exc_info=True)
-            await asyncio.sleep(1)
+            logger.warning(f"刷新目标用户出错: {str(e)}")
 
-async def handler(event):
-    global start_time
+async def handler(event, catch_up: bool = False):
+    """处理一条新消息；catch_up 为 True 时为补抓到的历史消息，不受启动基准时间限制"""
+    received_at = time.monotonic()
+    trace = None
+    client_index = None
     try:
-        if event.message.out:
+        message = event.message
+        if message.out:
+            return
+        
+        message_time = message.date
+        if message_time.tzinfo is None:
+            message_time = message_time.replace(tzinfo=timezone.utc)
+        
+        if start_time and message_time < start_time and not catch_up:
+            message_logger.info("⏮️ 忽略历史消息 ID %s (消息时间: %s, 启动时间: %s)", message.id, message_time, start_time)
             return
         
+        listener_index = client_indices.get(event.client)
+        listener_name = active_accounts[listener_index]['name'] if listener_index is not None else 'unknown'
+        if message.sender_id in targets_by_id:
+            # 无论稍后是否因去重跳过，本账号在该群组都已看到这条目标消息
+            chat_progress.observe(listener_name, event.chat_id, message.id)
+        
         id_key = make_id_key(event)
         async with message_dedup_lock:
             if id_key in seen_by_id:
+                metrics.inc('tguserbot_dedup_checks_total', stage='seen', result='hit')
+                if message.media and message.sender_id in targets_by_id:
+                    # 超级群组/频道中各账号看到的 message.id 相同，重复事件在此返回：登记为备用下载来源
+                    download_pool.add_source([id_key], event)
                 return
             seen_by_id.add(id_key)
+        metrics.inc('tguserbot_dedup_checks_total', stage='seen', result='miss')
+        if trace_writer:
+            trace = MessageTrace(event.chat_id, message.id, received_at, listener_name)
         
         dedup_keys = make_dedup_keys(event)
         
-        try:
-            listener_index = clients.index(event.client)
-            listener_name = active_accounts[listener_index]['name']
-        except ValueError:
-            listener_name = 'unknown'
+        message_logger.info("🔔 [%s] 收到新消息 - 消息ID: %s, 群组ID: %s, 去重键: %s", listener_name, message.id, event.chat_id, dedup_keys)
         
-        logger.info(f"🔔 [{listener_name}] 收到新消息 - 消息ID: {event.message.id}, 群组ID: {event.chat_id}, 去重键: {dedup_keys}")
+        target = targets_by_id.get(message.sender_id)
+        if target is not None:
+            user_type = "机器人" if target.is_bot else "普通用户"
+        else:
+            # 有目标 ID 未解析时的兜底：逐条获取发送者并按用户名匹配
+            sender = await event.get_sender()
+            if not sender:
+                logger.warning("⚠️ 无法获取发送者信息，sender 为 None")
+                return
+            if sender.id in our_user_ids:
+                return
+            target = targets_by_username.get((getattr(sender, 'username', None) or '').lower())
+            if target is None:
+                message_logger.debug("❌ 用户名不匹配，跳过处理: %s", getattr(sender, 'username', None))
+                return
+            user_type = "机器人" if getattr(sender, 'bot', False) else "普通用户"
+        if trace:
+            trace.mark('sender_resolved')
         
-        message_time = event.message.date
-        if message_time.tzinfo is None:
-            message_time = message_time.replace(tzinfo=timezone.utc)
+        if not target.in_scope(event.chat_id):
+            message_logger.debug("群组 %s 不在目标 @%s 的范围内，跳过", event.chat_id, target.username)
+            return
+        message_logger.info("✅ [%s] 匹配到目标用户: @%s (ID: %s)", listener_name, target.username, message.sender_id)
+        metrics.inc('tguserbot_messages_received_total', listener=listener_name)
+        if catch_up:
+            metrics.inc('tguserbot_catch_up_messages_total', listener=listener_name)
+            message_logger.info("🔁 [%s] 补抓到漏掉的目标消息 ID %s（消息时间: %s）", listener_name, message.id, message_time)
         
-        if start_time and message_time < start_time:
-            logger.info(f"⏮️ 忽略历史消息 ID {event.message.id} (消息时间: {message_time}, 启动时间: {start_time})")
+        album_key = make_album_key(event)
+        if album_key is not None:
+            await collect_album_part(event, album_key, dedup_keys, listener_name, user_type, target, received_at, trace)
             return
         
-        sender = await event.get_sender()
-        if sender:
-            if sender.id in our_user_ids:
-                return
-            sender_info = f"用户名: {sender.username or '无用户名'}, ID: {sender.id}, 是否机器人: {sender.bot}"
-            logger.info(f"👤 发送者信息 - {sender_info}, 群组: {event.chat_id}, 消息ID: {event.message.id}")
-        else:
-            logger.warning("⚠️ 无法获取发送者信息，sender 为 None")
+        async with message_dedup_lock:
+            client_index = await claim_message(dedup_keys, event.chat_id, target.distribution_strategy)
+        if client_index is None:
+            metrics.inc('tguserbot_dedup_checks_total', stage='claim', result='hit')
+            message_logger.info("⏭️ [%s] 目标消息已认领/已发送，跳过重复: %s", listener_name, dedup_keys)
+            if message.media:
+                download_pool.add_source(dedup_keys, event)
             return
+        metrics.inc('tguserbot_dedup_checks_total', stage='claim', result='miss')
+        if trace:
+            trace.mark('claimed')
         
-        logger.info(f"🔍 检查用户名匹配 - 目标: '{target_bot_username}', 实际: '{sender.username if sender else None}'")
+        async def load_media(task: MessageTask) -> None:
+            task.media = await download_pool.download(event, dedup_keys)
         
-        if sender and sender.username == target_bot_username:
-            async with message_dedup_lock:
-                if is_duplicate(dedup_keys, claimed_messages) or is_duplicate(dedup_keys, sent_messages):
-                    logger.info(f"⏭️ [{listener_name}] 目标消息已认领/已发送，跳过重复: {dedup_keys}")
-                    return
-                mark_keys(dedup_keys, claimed_messages)
-                client_index = pick_sender_index(event.chat_id)
-            
-            logger.info(f"✅ [{listener_name}] 匹配到目标用户: {sender.username} (ID: {sender.id})")
-            media = await download_message_media(event)
-            original_text = event.message.message or ''
-            msg_text = apply_text_replacements(original_text)
-            if msg_text != original_text:
-                logger.info(f"✏️ 文案替换: {original_text[:80]!r} → {msg_text[:80]!r}")
-            await enqueue_target_message(
-                event=event,
-                listener_name=listener_name,
-                chat_id=event.chat_id,
-                msg_text=msg_text,
-                media=media,
-                user_type="机器人" if sender.bot else "普通用户",
-                dedup_keys=dedup_keys,
-                client_index=client_index
-            )
-        else:
-            logger.info("❌ 用户名不匹配，跳过处理")
+        original_text = message.message or ''
+        msg_text = target.apply_replacements(original_text)
+        if msg_text != original_text:
+            message_logger.info("✏️ 文案替换: %.80r → %.80r", original_text, msg_text)
+        await enqueue_target_message(
+            event=event,
+            listener_name=listener_name,
+            chat_id=event.chat_id,
+            msg_text=msg_text,
+            media=None,
+            user_type=user_type,
+            dedup_keys=dedup_keys,
+            client_index=client_index,
+            received_at=received_at,
+            trace=trace,
+            media_loader=load_media if message.media else None,
+            media_source={'account': listener_name, 'message_ids': [message.id], 'album': False} if message.media else None
+        )
+        client_index = None
             
     except Exception as e:
         logger.error(f"❌ 处理消息时发生错误: {str(e)}", exc_info=True)
+        finish_trace(trace, 'error')
+        # 已分配但未能入队：归还账号负载
+        account_load.release(client_index)
+
+class ChatProgress:
+    """各账号在各群组中已看到的最大目标消息 ID，作为补抓的 min_id
+    
+    按账号区分：普通群组的消息 ID 在每个账号下各不相同，超级群组/频道的 ID 虽全局一致，分开记录也无妨。
+    """
+    def __init__(self):
+        self._last: Dict[Tuple[str, int], int] = {}
+
+    def load(self, rows: List[Tuple[str, int, int]]) -> None:
+        for account, chat_id, last_id in rows:
+            self._last[(account, chat_id)] = last_id
+
+    def observe(self, account: str, chat_id: int, message_id: int) -> None:
+        key = (account, chat_id)
+        if message_id <= self._last.get(key, 0):
+            return
+        self._last[key] = message_id
+        if task_journal:
+            task_journal.record_progress(account, chat_id, message_id)
+
+    def chats(self, account: str) -> Dict[int, int]:
+        return {chat_id: last_id for (name, chat_id), last_id in self._last.items() if name == account}
+
+    def __len__(self) -> int:
+        return len(self._last)
+
+async def catch_up_chat(client: TelegramClient, chat_id: int, last_id: int, target: TargetConfig,
+                        horizon: datetime, semaphore: asyncio.Semaphore) -> int:
+    """拉取一个群组中 last_id 之后该目标发出的消息（最多 catch_up_limit 条，不早于 horizon），按时间顺序交给 handler"""
+    messages = []
+    async with semaphore:
+        async for message in client.iter_messages(chat_id, limit=catch_up_limit, min_id=last_id, from_user=target.user_id):
+            message_time = message.date if message.date.tzinfo else message.date.replace(tzinfo=timezone.utc)
+            if message_time < horizon:
+                break
+            messages.append(message)
+    if len(messages) >= catch_up_limit:
+        logger.warning(f"⚠️ 群组 {chat_id} 中 @{target.username} 漏掉的消息超过单次补抓上限 {catch_up_limit} 条，只补抓最近的部分")
+    for message in reversed(messages):
+        event = events.NewMessage.Event(message)
+        event._set_client(client)
+        await handler(event, catch_up=True)
+    return len(messages)
+
+async def catch_up_account(index: int, reason: str, semaphore: asyncio.Semaphore) -> None:
+    """为一个账号补抓其记录过进度的各群组中漏掉的目标消息，补抓结果走正常的去重与分配流程"""
+    client = clients[index]
+    name = active_accounts[index]['name']
+    horizon = datetime.now(timezone.utc) - timedelta(seconds=catch_up_max_age)
+    jobs = []
+    for chat_id, last_id in chat_progress.chats(name).items():
+        for target in targets:
+            if target.user_id is not None and target.in_scope(chat_id):
+                jobs.append(catch_up_chat(client, chat_id, last_id, target, horizon, semaphore))
+    if not jobs:
+        return
+    started = time.monotonic()
+    results = await asyncio.gather(*jobs, return_exceptions=True)
+    recovered = sum(r for r in results if not isinstance(r, BaseException))
+    errors = [r for r in results if isinstance(r, BaseException)]
+    for error in errors:
+        logger.warning(f"[{name}] 补抓出错: {str(error)}")
+    logger.info(f"🔁 [{name}] {reason}补抓完成: 检查 {len(jobs)} 个 (群组, 目标)，补抓 {recovered} 条，耗时 {time.monotonic() - started:.1f} 秒")
+
+async def catch_up_loop():
+    """启动时为所有账号补抓一次；之后定期检查连接状态，账号断线后恢复连接（或被连接监督重连）时再补抓"""
+    semaphore = asyncio.Semaphore(catch_up_concurrency)
+    connected: Dict[int, bool] = {}
+    generations: Dict[int, int] = {}
+    running: Dict[int, asyncio.Task] = {}
+    try:
+        while True:
+            try:
+                for index, client in enumerate(clients):
+                    now_connected = client.is_connected()
+                    was_connected = connected.get(index)
+                    connected[index] = now_connected
+                    if not now_connected:
+                        continue
+                    generation = account_health.reconnects[index]
+                    if was_connected is True and generations.get(index) == generation:
+                        continue
+                    if index in running and not running[index].done():
+                        continue
+                    generations[index] = generation
+                    reason = '启动' if was_connected is None else '重连后'
+                    running[index] = asyncio.create_task(catch_up_account(index, reason, semaphore))
+            except Exception as e:
+                logger.warning(f"补抓检查出错: {str(e)}")
+            await asyncio.sleep(catch_up_check_interval)
+    except asyncio.CancelledError:
+        for task in running.values():
+            task.cancel()
+
+def track_updates(client: TelegramClient, index: int) -> None:
+    """任何更新到达都刷新该账号的最近更新时间，供连接监督判断是否停滞"""
+    async def on_update(update):
+        account_health.touch(index)
+    client.add_event_handler(on_update, events.Raw)
+
+async def check_account(index: int) -> Optional[str]:
+    """检查账号连接，健康时返回 None，否则返回失活原因；较长时间没有更新时用 updates.GetState 做一次 ping"""
+    client = clients[index]
+    if not client.is_connected():
+        return "连接已断开"
+    if time.monotonic() - account_health.last_update[index] < health_update_timeout:
+        return None
+    try:
+        await asyncio.wait_for(client(GetStateRequest()), timeout=health_ping_timeout)
+    except asyncio.TimeoutError:
+        return f"{health_update_timeout:.0f} 秒无更新且 ping 超过 {health_ping_timeout:g} 秒无响应"
+    except Exception as e:
+        return f"ping 失败: {str(e)}"
+    account_health.touch(index)
+    return None
+
+async def reconnect_account(index: int) -> bool:
+    """断开并重新连接账号，返回 session 是否仍然有效"""
+    client = clients[index]
+    try:
+        await asyncio.wait_for(client.disconnect(), timeout=connect_timeout)
+    except Exception as e:
+        logger.debug(f"[{active_accounts[index]['name']}] 断开旧连接出错: {str(e)}")
+    await asyncio.wait_for(client.connect(), timeout=connect_timeout)
+    return await asyncio.wait_for(client.is_user_authorized(), timeout=connect_timeout)
+
+async def supervise_account(index: int) -> None:
+    """单个账号的连接监督：定期检查连接，失活时移出发送分配并带指数退避重连，成功后重新加入
+    
+    各账号独立运行，一个账号重连不影响其他账号；session 失效（需要重新登录）时停止监督并保持停用。
+    """
+    name = active_accounts[index]['name']
+    while True:
+        try:
+            await asyncio.sleep(health_check_interval)
+            reason = await check_account(index)
+            if reason is None:
+                continue
+            account_health.mark_unhealthy(index, reason)
+            delay = reconnect_backoff_initial
+            while True:
+                try:
+                    authorized = await reconnect_account(index)
+                except Exception as e:
+                    logger.warning(f"[{name}] 重连失败: {str(e) or type(e).__name__}，{delay:.0f} 秒后重试")
+                else:
+                    if not authorized:
+                        logger.error(f"[{name}] session 已失效，需要在终端中重新登录；该账号保持停用")
+                        return
+                    account_health.mark_healthy(index)
+                    break
+                await asyncio.sleep(delay * random.uniform(1.0, 1.2))
+                delay = min(delay * 2, reconnect_backoff_max)
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            logger.warning(f"[{name}] 连接监督出错: {str(e)}")
+
+class StartupCache:
+    """账号身份与目标实体的 JSON 缓存：重启时直接使用，目标实体在启动后由后台刷新校正"""
+    def __init__(self, path: Optional[str], ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self.data: Dict[str, dict] = {'accounts': {}, 'targets': {}}
+        self._dirty = False
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    loaded = json.load(f)
+                self.data['accounts'].update(loaded.get('accounts', {}))
+                self.data['targets'].update(loaded.get('targets', {}))
+            except (OSError, ValueError) as e:
+                logger.warning(f"启动缓存读取失败，将重新查询: {str(e)}")
+
+    def _get(self, section: str, key: str) -> Optional[dict]:
+        entry = self.data[section].get(key)
+        if entry is None or time.time() - entry.get('cached_at', 0) > self.ttl:
+            return None
+        return entry
+
+    def _put(self, section: str, key: str, entry: dict) -> None:
+        entry['cached_at'] = time.time()
+        self.data[section][key] = entry
+        self._dirty = True
+
+    def get_account(self, key: str) -> Optional[dict]:
+        return self._get('accounts', key)
+
+    def put_account(self, key: str, me) -> dict:
+        identity = {'id': me.id, 'username': me.username, 'first_name': me.first_name}
+        self._put('accounts', key, identity)
+        return identity
+
+    def get_target(self, username: str) -> Optional[dict]:
+        return self._get('targets', username.lower())
+
+    def put_target(self, target: TargetConfig) -> None:
+        self._put('targets', target.username.lower(), {'id': target.user_id, 'is_bot': target.is_bot})
+
+    def save(self) -> None:
+        if not self.path or not self._dirty:
+            return
+        tmp_path = f'{self.path}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except OSError as e:
+            logger.warning(f"启动缓存保存失败: {str(e)}")
 
 def prompt_input(message: str) -> str:
-    """在日志输出后仍能可见的交互输入"""
+    """在日志输出后仍能可见的交互输入（在线程中调用，等待输入时不阻塞其他账号连接）"""
     print(message, end='', flush=True)
     return input()
 
-async def start_client(client: TelegramClient, account: dict) -> None:
-    """连接并登录单个客户端，带明确的交互提示"""
+def account_cache_key(account: dict) -> str:
+    return f"{account['name']}_{account['api_id']}"
+
+async def start_client(client: TelegramClient, account: dict) -> Optional[dict]:
+    """连接并登录单个客户端，返回账号身份 {id, username, first_name}
+    
+    已登录的账号优先使用启动缓存中的身份；需要交互登录时，无人值守模式下返回 None（跳过该账号），
+    否则在 login_lock 下逐个提示输入，避免多个账号的提示交错。
+    """
     name = account['name']
+    cache_key = account_cache_key(account)
     logger.info(f"[{name}] 正在连接 Telegram 服务器...")
 
-    await client.connect()
+    await asyncio.wait_for(client.connect(), timeout=connect_timeout)
     logger.info(f"[{name}] 连接成功，正在验证登录状态...")
 
-    if await client.is_user_authorized():
-        me = await client.get_me()
-        username = me.username or '无用户名'
-        logger.info(f"✓ [{name}] 已登录: {me.first_name} (@{username}, ID: {me.id})")
-        return
+    if await asyncio.wait_for(client.is_user_authorized(), timeout=connect_timeout):
+        identity = startup_cache.get_account(cache_key)
+        source = "缓存"
+        if identity is None:
+            identity = startup_cache.put_account(cache_key, await client.get_me())
+            source = "get_me"
+        username = identity['username'] or '无用户名'
+        logger.info(f"✓ [{name}] 已登录: {identity['first_name']} (@{username}, ID: {identity['id']}，来自{source})")
+        return identity
+
+    if headless:
+        logger.warning(f"⚠️ [{name}] session 未登录或已失效，无人值守模式下跳过（请在终端中运行一次完成登录）")
+        return None
 
+    async with login_lock:
+        return await interactive_login(client, account)
+
+async def interactive_login(client: TelegramClient, account: dict) -> dict:
+    """在终端中输入手机号、验证码（及两步验证密码）完成登录"""
+    name = account['name']
     logger.info(f"[{name}] session 未登录或已失效，需要重新验证")
     print(f"\n{'=' * 60}", flush=True)
     print(f"📱 账户 [{name}] 需要登录 Telegram", flush=True)
     print(f"{'=' * 60}", flush=True)
 
-    phone = prompt_input(f"[{name}] 请输入手机号（格式 +86 13800138000）: ")
+    phone = await asyncio.to_thread(prompt_input, f"[{name}] 请输入手机号（格式 +86 13800138000）: ")
     await client.send_code_request(phone)
-    code = prompt_input(f"[{name}] 请输入 Telegram 发送的验证码: ")
+    code = await asyncio.to_thread(prompt_input, f"[{name}] 请输入 Telegram 发送的验证码: ")
 
     try:
         await client.sign_in(phone, code)
     except SessionPasswordNeededError:
-        password = prompt_input(f"[{name}] 请输入两步验证密码: ")
+        password = await asyncio.to_thread(prompt_input, f"[{name}] 请输入两步验证密码: ")
         await client.sign_in(password=password)
 
     me = await client.get_me()
     username = me.username or '无用户名'
     logger.info(f"✓ [{name}] 登录成功: {me.first_name} (@{username}, ID: {me.id})")
+    return startup_cache.put_account(account_cache_key(account), me)
+
+async def connect_account(account: dict, semaphore: asyncio.Semaphore) -> Optional[Tuple[TelegramClient, dict]]:
+    """在并发上限内创建并登录一个账号，失败或被跳过时返回 None"""
+    name = account['name']
+    async with semaphore:
+        client = create_client(account)
+        session_file = os.path.join(workdir, f'session_{name}_{account["api_id"]}.session')
+        logger.info(f"[{name}] 检查 session 文件: {session_file} (存在: {os.path.exists(session_file)})")
+        try:
+            identity = await start_client(client, account)
+            if identity is not None:
+                return client, identity
+        except Exception as e:
+            logger.error(f"✗ [{name}] 启动失败，跳过该账户: {str(e) or type(e).__name__}", exc_info=True)
+        try:
+            await client.disconnect()
+        except Exception:
+            pass
+        return None
 
 def create_client(account: dict) -> TelegramClient:
     """在事件循环内创建 Telegram 客户端"""
@@ -471,102 +3458,465 @@ def create_client(account: dict) -> TelegramClient:
     name = account['name']
     session_name = f'session_{name}_{api_id}'
     session_path = os.path.join(workdir, session_name)
-    client = TelegramClient(session_path, api_id, api_hash)
+    client = TelegramClient(session_path, api_id, api_hash, flood_sleep_threshold=flood_sleep_threshold)
     logger.info(f"创建客户端: {name} (api_id: {api_id}, session: {session_name})")
     return client
 
+def enabled_account_list(account_list: Optional[List[dict]] = None) -> List[dict]:
+    if account_list is None:
+        account_list = accounts
+    return [account for account in account_list if account.get('enabled', True) is not False]
+
+def shard_accounts(account_list: List[dict], index: int) -> List[dict]:
+    """分配给第 index 个分片的账号（启动、热加载与 worker 重启共用同一规则）"""
+    return [account for account in account_list if account_shard(account['name'], shard_count) == index]
+
+# 热加载时直接替换的简单配置项：配置键 → (默认值, 转换函数)
+RELOADABLE_SETTINGS = {
+    'send_interval': (2.0, float),
+    'send_jitter': (1.0, float),
+    'max_flood_wait': (600, float),
+    'rate_limit_per_minute': (20, float),
+    'rate_limit_burst': (3, float),
+    'flood_wait_padding': (1.0, float),
+    'send_queue_max_size': (1000, lambda v: max(0, int(v))),
+    'send_queue_full_timeout': (10, float),
+    'send_queue_max_age': (0, float),
+    'priority_large_media_bytes': (20 * 1024 * 1024, int),
+    'priority_aging': (30, float),
+    'album_collect_window': (1.0, float),
+    'target_refresh_interval': (3600, float),
+    'catch_up_max_age': (3600, float),
+    'catch_up_limit': (50, lambda v: max(1, int(v))),
+    'health_check_interval': (30, float),
+    'health_update_timeout': (300, float),
+    'health_ping_timeout': (10, float),
+    'reconnect_backoff_initial': (5, float),
+    'reconnect_backoff_max': (300, float),
+    'status_report_interval': (600, float),
+    'log_message_sample_rate': (1.0, lambda v: min(1.0, max(0.0, float(v)))),
+}
+# 除上表外可热加载的配置项；其余配置项（端口、路径、分片、日志、缓存容量等）修改后需要重启
+RELOADABLE_KEYS = set(RELOADABLE_SETTINGS) | {
+    'accounts', 'api_id', 'api_hash', 'targets', 'target_bot_username',
+    'text_replacements', 'text_prefix_replace', 'distribution_strategy', 'chat_allowlist',
+}
+
+async def retire_account(index: int) -> None:
+    """停用已从配置中移除或禁用的账号：停止监督并断开连接；索引保留，已排队的任务由其他账号发送"""
+    account_health.retire(index)
+    task = account_supervisors.pop(index, None)
+    if task:
+        task.cancel()
+    client = clients[index]
+    client_indices.pop(client, None)
+    try:
+        await asyncio.wait_for(client.disconnect(), timeout=connect_timeout)
+    except Exception as e:
+        logger.debug(f"[{active_accounts[index]['name']}] 断开连接出错: {str(e)}")
+    logger.info(f"➖ [{active_accounts[index]['name']}] 已从配置中移除或禁用，已停止接收和发送")
+
+def add_account(account: dict, client: TelegramClient, identity: dict) -> None:
+    """接入热加载新增（或重新启用）的账号；重新启用的账号沿用原索引，保留其负载与冷却状态"""
+    names = [a['name'] for a in active_accounts]
+    if account['name'] in names:
+        index = names.index(account['name'])
+        clients[index] = client
+        active_accounts[index] = account
+        account_health.revive(index)
+    else:
+        index = len(clients)
+        clients.append(client)
+        active_accounts.append(account)
+        account_load.add()
+        account_health.add()
+    client_indices[client] = index
+    our_user_ids.add(identity['id'])
+    register_message_handler(client)
+    track_updates(client, index)
+    send_scheduler.start_worker(index)
+    account_supervisors[index] = asyncio.create_task(supervise_account(index))
+    logger.info(f"➕ [{account['name']}] 已加入（索引 {index}）")
+
+async def reconcile_accounts() -> None:
+    """按当前配置增减账号：仍启用的在线账号保持连接不动，移除的停用，新增的连接后加入"""
+    wanted = enabled_account_list()
+    if shard_index is not None:
+        wanted = shard_accounts(wanted, shard_index)
+    wanted_names = {account['name'] for account in wanted}
+    for index, account in enumerate(active_accounts):
+        if not account_health.retired[index] and account['name'] not in wanted_names:
+            await retire_account(index)
+    live_names = {account['name'] for index, account in enumerate(active_accounts) if not account_health.retired[index]}
+    added = [account for account in wanted if account['name'] not in live_names]
+    if not added:
+        return
+    semaphore = asyncio.Semaphore(startup_concurrency)
+    results = await asyncio.gather(*(connect_account(account, semaphore) for account in added))
+    for account, result in zip(added, results):
+        if result is not None:
+            add_account(account, *result)
+    startup_cache.save()
+
+async def reload_config() -> None:
+    """重新读取配置并就地应用，已连接的账号、队列中的任务和去重状态均保持不变
+    
+    新配置先完整校验，有误时保留当前配置；目标与文案替换规则、发送节奏、限速、队列参数立即生效，账号按差异增减。
+    """
+    global config, accounts, distribution_strategy, targets, targets_by_username, chat_allowlist
+    async with reload_lock:
+        try:
+            new_config = read_config()
+            new_targets = parse_targets(new_config)
+            settings = {key: convert(new_config.get(key, default)) for key, (default, convert) in RELOADABLE_SETTINGS.items()}
+            new_allowlist = frozenset(new_config['chat_allowlist']) if new_config.get('chat_allowlist') else None
+            if not any(account.get('enabled', True) is not False for account in new_config['accounts']):
+                raise ValueError("新配置中没有启用的账号")
+        except (ValueError, TypeError, KeyError) as e:
+            logger.error(f"❌ 重新加载配置失败，继续使用当前配置: {str(e) or type(e).__name__}")
+            return
+        restart_keys = sorted(
+            key for key in set(config) | set(new_config)
+            if key not in RELOADABLE_KEYS and config.get(key) != new_config.get(key)
+        )
+        changed = [key for key, value in settings.items() if globals()[key] != value]
+        globals().update(settings)
+        rate_limiter.reconfigure(rate_limit_per_minute, rate_limit_burst, flood_wait_padding)
+        send_scheduler.reconfigure(send_queue_max_size, send_queue_full_timeout, send_queue_max_age)
+        album_collector.window = album_collect_window
+        log_sampler.rate = log_message_sample_rate
+        
+        # 目标：已解析的 ID 按用户名沿用，新目标在下面解析
+        previous = targets_by_username
+        for target in new_targets:
+            old = previous.get(target.username.lower())
+            if old is not None:
+                target.user_id = old.user_id
+                target.is_bot = old.is_bot
+        config = new_config
+        accounts = new_config['accounts']
+        distribution_strategy = normalize_strategy(new_config.get('distribution_strategy', 'round_robin'))
+        targets = new_targets
+        targets_by_username = {t.username.lower(): t for t in targets}
+        chat_allowlist = new_allowlist
+        await resolve_targets(skip_resolved=True)
+        for index, client in enumerate(clients):
+            if not account_health.retired[index]:
+                register_message_handler(client)
+        
+        await reconcile_accounts()
+        live = [a['name'] for index, a in enumerate(active_accounts) if not account_health.retired[index]]
+        logger.info(f"🔄 配置已重新加载: 目标 {', '.join('@' + t.username for t in targets)}；在线账号 {len(live)} 个: {', '.join(live)}")
+        if changed:
+            logger.info(f"🔄 已更新: {', '.join(changed)}")
+        if restart_keys:
+            logger.warning(f"⚠️ 以下配置项的修改需要重启才能生效: {', '.join(restart_keys)}")
+
+def request_reload() -> None:
+    """SIGHUP 处理：在后台重新加载配置；启动尚未完成时忽略"""
+    if start_time is None:
+        logger.warning("收到 SIGHUP，但启动尚未完成，忽略本次重新加载")
+        return
+    logger.info("收到 SIGHUP，重新加载配置...")
+    task = asyncio.create_task(reload_config())
+    pending_reloads.add(task)
+    task.add_done_callback(reload_done)
+
+def reload_done(task: asyncio.Task) -> None:
+    pending_reloads.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"❌ 应用新配置时出错: {str(task.exception())}", exc_info=task.exception())
+
+shard_processes: Dict[int, asyncio.subprocess.Process] = {}
+shard_supervisors: Dict[int, asyncio.Task] = {}
+
+def current_shard_accounts(index: int) -> List[dict]:
+    """按配置文件的当前内容计算分片的账号；配置读取失败时沿用启动时的账号列表"""
+    try:
+        account_list = read_config()['accounts']
+    except ValueError as e:
+        logger.warning(f"⚠️ 读取配置失败，沿用启动时的账号列表: {e}")
+        account_list = accounts
+    return shard_accounts(enabled_account_list(account_list), index)
+
+def start_shards() -> None:
+    """为有账号但尚未运行的分片启动 worker；没有账号的分片不启动"""
+    for index in range(shard_count):
+        supervisor = shard_supervisors.get(index)
+        if (supervisor is None or supervisor.done()) and current_shard_accounts(index):
+            shard_supervisors[index] = asyncio.create_task(supervise_shard(index))
+
+def forward_reload() -> None:
+    """协调者收到 SIGHUP：转发给各分片 worker，由各 worker 自行重新加载配置；新增账号落到未运行的分片时启动该分片"""
+    for index, process in shard_processes.items():
+        if process.returncode is None:
+            process.send_signal(signal.SIGHUP)
+    logger.info(f"🔄 已将 SIGHUP 转发给 {len(shard_processes)} 个分片")
+    start_shards()
+
+async def supervise_shard(index: int) -> None:
+    """启动并看护一个分片 worker 进程，退出后延迟重启，分片已没有账号时不再重启；取消时终止进程"""
+    env = dict(os.environ, TGUSERBOT_SHARD=f'{index}/{shard_count}')
+    backoff = 5.0
+    while True:
+        if not current_shard_accounts(index):
+            shard_processes.pop(index, None)
+            logger.info(f"🧩 分片 {index} 已没有账号，不再启动")
+            return
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__),
+            env=env, stdin=asyncio.subprocess.DEVNULL
+        )
+        shard_processes[index] = process
+        logger.info(f"🧩 分片 {index} 已启动 (PID: {process.pid})")
+        started = time.monotonic()
+        try:
+            returncode = await process.wait()
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                process.terminate()
+                try:
+                    await asyncio.wait_for(process.wait(), timeout=40)
+                except asyncio.TimeoutError:
+                    process.kill()
+                    await process.wait()
+            logger.info(f"🧩 分片 {index} 已停止")
+            raise
+        backoff = 5.0 if time.monotonic() - started > 60 else min(backoff * 2, 300.0)
+        logger.warning(f"⚠️ 分片 {index} 退出（返回码 {returncode}），{backoff:.0f} 秒后重启")
+        await asyncio.sleep(backoff)
+
+async def run_coordinator() -> None:
+    """多进程模式的主进程：提供认领协调服务并看护各分片 worker"""
+    coordinator_state = ClaimCoordinator()
+    if task_journal_path:
+        await coordinator_state.load_journals([shard_suffixed(task_journal_path, i) for i in range(shard_count)])
+    if os.path.exists(coordinator_socket):
+        os.remove(coordinator_socket)
+    server = await asyncio.start_unix_server(coordinator_state.handle_connection, path=coordinator_socket)
+    logger.info(f"🧭 协调者已启动: {coordinator_socket}，{len(enabled_account_list())} 个账号分为 {shard_count} 个分片")
+    start_shards()
+    loop = asyncio.get_running_loop()
+    if hasattr(signal, 'SIGHUP'):
+        loop.add_signal_handler(signal.SIGHUP, forward_reload)
+    try:
+        while True:
+            await asyncio.sleep(status_report_interval)
+            coordinator_state.prune()
+            logger.info(
+                f"🧭 协调者状态 - 认领成功 {coordinator_state.granted} 次，拒绝重复 {coordinator_state.rejected} 次，"
+                f"认领键 {len(coordinator_state.claimed)} 条，已发送键 {len(coordinator_state.sent)} 条"
+            )
+    finally:
+        if hasattr(signal, 'SIGHUP'):
+            loop.remove_signal_handler(signal.SIGHUP)
+        for supervisor in shard_supervisors.values():
+            supervisor.cancel()
+        await asyncio.gather(*shard_supervisors.values(), return_exceptions=True)
+        server.close()
+        if os.path.exists(coordinator_socket):
+            os.remove(coordinator_socket)
+
 async def main():
-    global clients, active_accounts, message_queue, message_dedup_lock, start_time
+    if shard_count > 1 and shard_index is None:
+        await run_coordinator()
+        return
+    global clients, active_accounts, send_scheduler, rate_limiter, upload_cache, media_budget, album_collector, task_journal, message_dedup_lock, start_time
     global seen_by_id, claimed_messages, sent_messages, our_user_ids
-    global chat_client_index, chat_client_usage
+    global chat_client_index, chat_client_usage, account_load, download_pool, client_indices, targets_by_id, trace_writer, startup_cache, login_lock, coordinator
+    global chat_progress, media_cache, account_health, account_supervisors, reload_lock
     clients = []
     active_accounts = []
-    message_queue = asyncio.Queue()
+    client_indices = {}
+    targets_by_id = {}
+    send_scheduler = SendScheduler(send_queue_max_size, send_queue_full_timeout, send_queue_max_age)
+    rate_limiter = RateLimiter(rate_limit_per_minute, rate_limit_burst, flood_wait_padding)
+    upload_cache = UploadCache(upload_cache_ttl, upload_cache_max_entries)
+    media_budget = MediaMemoryBudget(media_memory_budget)
+    album_collector = AlbumCollector(album_collect_window)
+    download_pool = DownloadPool(download_workers)
+    media_cache = MediaCache(media_cache_memory_bytes, media_cache_disk_bytes, os.path.join(media_spool_dir, 'cache'))
     message_dedup_lock = asyncio.Lock()
-    seen_by_id = set()
-    claimed_messages = set()
-    sent_messages = set()
+    login_lock = asyncio.Lock()
+    startup_cache = StartupCache(startup_cache_path, startup_cache_ttl)
+    coordinator = CoordinatorClient(coordinator_socket, coordinator_timeout, coordinator_retry_interval) if shard_index is not None else None
+    seen_by_id = DedupStore('seen_by_id')
+    claimed_messages = DedupStore('claimed')
+    sent_messages = DedupStore('sent')
     our_user_ids = set()
-    chat_client_index = defaultdict(int)
-    chat_client_usage = defaultdict(lambda: defaultdict(int))
-    sender_task = None
+    chat_client_index = ChatCounters(int, distribution_max_chats)
+    chat_client_usage = ChatCounters(lambda: defaultdict(int), distribution_max_chats)
+    chat_progress = ChatProgress()
+    maintenance_task = None
+    catch_up_task = None
+    account_supervisors = {}
+    reload_lock = asyncio.Lock()
+    loop = asyncio.get_running_loop()
+    reload_signal = hasattr(signal, 'SIGHUP')
+    refresh_task = None
+    journal_task = None
+    metrics_server = None
+    task_journal = TaskJournal(task_journal_path, journal_flush_interval) if task_journal_path else None
+    trace_writer = None
+    if trace_file and (trace_sample_rate > 0 or trace_slow_threshold > 0):
+        trace_writer = TraceWriter(trace_file, trace_sample_rate, trace_slow_threshold, trace_max_bytes, trace_backup_count)
     start_time = None
     
     try:
         logger.info(f"进程 PID: {os.getpid()}")
+        if reload_signal:
+            loop.add_signal_handler(signal.SIGHUP, request_reload)
+        if task_journal:
+            task_journal.open()
+            logger.info(f"任务日志: {task_journal_path}")
+            chat_progress.load(task_journal.load_progress(time.time() - catch_up_max_age))
+            clear_media_spool(journal_spool_paths())
+        else:
+            clear_media_spool()
+        media_cache.open()
         logger.info("正在启动 Telegram 客户端...")
         logger.info(f"共配置 {len(accounts)} 个账户")
         logger.info(f"发送间隔: {send_interval}秒，抖动时间: 0-{send_jitter}秒")
-        logger.info(f"目标用户名: {target_bot_username}")
-        logger.info(f"分配策略: {distribution_strategy}")
+        logger.info(f"监听目标: {', '.join('@' + t.username for t in targets)}")
         
         for account in accounts:
-            name = account['name']
             if account.get('enabled', True) is False:
-                logger.info(f"[{name}] 已禁用（enabled=false），跳过")
-                continue
-            
-            client = create_client(account)
-            session_file = os.path.join(workdir, f'session_{name}_{account["api_id"]}.session')
-            logger.info(f"[{name}] 检查 session 文件: {session_file} (存在: {os.path.exists(session_file)})")
-            
-            try:
-                await start_client(client, account)
-                me = await client.get_me()
-                our_user_ids.add(me.id)
-            except Exception as e:
-                logger.error(f"✗ [{name}] 启动失败，跳过该账户: {str(e)}", exc_info=True)
-                try:
-                    await client.disconnect()
-                except Exception:
-                    pass
+                logger.info(f"[{account['name']}] 已禁用（enabled=false），跳过")
+        enabled_accounts = enabled_account_list()
+        if shard_index is not None:
+            enabled_accounts = shard_accounts(enabled_accounts, shard_index)
+            logger.info(f"🧩 分片 {shard_index}/{shard_count}: 负责 {', '.join(a['name'] for a in enabled_accounts)}")
+        
+        started = time.monotonic()
+        if headless:
+            logger.info("无人值守模式：需要交互登录的账号将被跳过")
+        semaphore = asyncio.Semaphore(startup_concurrency)
+        results = await asyncio.gather(*(connect_account(account, semaphore) for account in enabled_accounts))
+        # 按配置顺序分配账号索引，与连接完成的先后无关
+        for account, result in zip(enabled_accounts, results):
+            if result is None:
                 continue
-            
-            client.add_event_handler(handler, events.NewMessage(incoming=True))
+            client, identity = result
+            our_user_ids.add(identity['id'])
+            client_indices[client] = len(clients)
             clients.append(client)
             active_accounts.append(account)
-            logger.info(f"✓ [{name}] 客户端已就绪，消息监听已注册")
+            logger.info(f"✓ [{account['name']}] 客户端已就绪")
+        logger.info(f"账号连接完成: {len(clients)}/{len(enabled_accounts)} 个可用，耗时 {time.monotonic() - started:.1f} 秒（并发 {startup_concurrency}）")
         
         if not clients:
             logger.error("没有可用的客户端，请检查账户配置或登录状态")
             return
+        account_load = AccountLoad(len(clients), failure_penalty)
+        account_health = AccountHealth(len(clients))
+        
+        cached_targets = load_cached_targets()
+        await resolve_targets(skip_resolved=True)
+        startup_cache.save()
+        for index, client in enumerate(clients):
+            register_message_handler(client)
+            track_updates(client, index)
+        if chat_allowlist is not None:
+            logger.info(f"群组白名单: {len(chat_allowlist)} 个群组")
+        logger.info(f"✓ 已为 {len(clients)} 个账号注册消息监听")
         
         start_time = datetime.now(timezone.utc)
         logger.info(f"监听基准时间: {start_time.strftime('%Y-%m-%d %H:%M:%S UTC')}（此时间之前的消息视为历史消息）")
         
         logger.info("=" * 60)
         logger.info(f"✓ 已启动 {len(clients)} 个客户端: {', '.join(a['name'] for a in active_accounts)}")
-        logger.info("所有在线账户均监听；同一消息只处理一次；发送按 distribution_strategy 分配唯一账号")
+        logger.info("所有在线账户均监听；同一消息只处理一次；发送按各目标的 distribution_strategy 分配唯一账号")
         logger.info("=" * 60)
         
-        sender_task = asyncio.create_task(message_sender())
-        logger.info("消息队列发送任务已启动，等待消息...")
+        if task_journal:
+            await replay_journal()
+            journal_task = asyncio.create_task(task_journal.run())
+        download_pool.start()
+        for index in range(len(clients)):
+            send_scheduler.start_worker(index)
+        logger.info(f"已为 {len(clients)} 个账号启动并行发送 worker，等待消息...")
+        maintenance_task = asyncio.create_task(periodic_maintenance())
+        if catch_up_enabled:
+            catch_up_task = asyncio.create_task(catch_up_loop())
+            logger.info(f"🔁 断线补抓: 已记录 {len(chat_progress)} 个 (账号, 群组) 的进度，最多回溯 {catch_up_max_age:.0f} 秒，每群组每目标 {catch_up_limit} 条")
+        # 使用了缓存的目标实体时，启动后立即在后台校正一次
+        refresh_task = asyncio.create_task(target_refresh_loop(0 if cached_targets else None))
+        if metrics_port:
+            metrics_server = await asyncio.start_server(handle_metrics_request, metrics_host, metrics_port)
+            logger.info(f"📈 指标端点: http://{metrics_host}:{metrics_port}/metrics")
+        logger.info(f"去重存储: TTL {dedup_ttl:.0f}秒，每类上限 {dedup_max_entries} 条")
+        logger.info(f"限速: 每账号每群组 {rate_limit_per_minute:g} 条/分钟，突发 {rate_limit_burst:g} 条")
+        if trace_writer:
+            logger.info(f"🧭 链路追踪: {trace_file}（采样率 {trace_sample_rate:g}，慢消息阈值 {trace_slow_threshold:g} 秒）")
         
         logger.info("程序运行中，等待消息...")
         logger.info("=" * 60)
         logger.info("📢 提示：请在 Telegram 中发送一条测试消息")
         logger.info("=" * 60)
         
-        await asyncio.gather(*[client.run_until_disconnected() for client in clients])
+        # 每个账号由各自的连接监督维持在线，session 全部失效（或热加载移除了全部账号）时才退出
+        for index in range(len(clients)):
+            account_supervisors[index] = asyncio.create_task(supervise_account(index))
+        logger.info(f"🩺 连接监督: 每 {health_check_interval:g} 秒检查一次，{health_update_timeout:g} 秒无更新时 ping，重连退避 {reconnect_backoff_initial:g}~{reconnect_backoff_max:g} 秒")
+        if reload_signal:
+            logger.info(f"🔄 发送 SIGHUP 可重新加载配置（kill -HUP {os.getpid()}）")
+        while True:
+            running = [task for task in account_supervisors.values() if not task.done()]
+            if not running:
+                break
+            await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            # 热加载正在增减账号时等待其完成后再判断
+            async with reload_lock:
+                pass
+        logger.error("没有仍在运行的账号（session 均已失效或已从配置中移除），程序退出")
         
     except KeyboardInterrupt:
         logger.info("收到中断信号，正在关闭...")
     finally:
-        if sender_task:
-            sender_task.cancel()
+        if reload_signal:
+            loop.remove_signal_handler(signal.SIGHUP)
+        for task in pending_reloads:
+            task.cancel()
+        for task in account_supervisors.values():
+            task.cancel()
+        if maintenance_task:
+            maintenance_task.cancel()
+        if catch_up_task:
+            catch_up_task.cancel()
+        if refresh_task:
+            refresh_task.cancel()
+        if metrics_server:
+            metrics_server.close()
+        if send_scheduler and not send_scheduler.empty():
+            logger.info(f"等待队列中的 {send_scheduler.qsize()} 条消息发送完成...")
             try:
-                await sender_task
-            except asyncio.CancelledError:
-                pass
+                await asyncio.wait_for(send_scheduler.join(), timeout=30.0)
+            except asyncio.TimeoutError:
+                logger.warning("等待消息发送超时，强制关闭")
+        
+        if send_scheduler:
+            try:
+                await send_scheduler.stop()
             except Exception as e:
-                logger.warning(f"取消发送任务时出错: {str(e)}")
+                logger.warning(f"停止发送 worker 时出错: {str(e)}")
+        if download_pool:
+            await download_pool.stop()
+        if media_cache:
+            media_cache.close()
         
-        if message_queue and not message_queue.empty():
-            logger.info(f"等待队列中的 {message_queue.qsize()} 条消息发送完成...")
+        if journal_task:
+            journal_task.cancel()
+            await asyncio.gather(journal_task, return_exceptions=True)
+        if task_journal:
             try:
-                await asyncio.wait_for(message_queue.join(), timeout=30.0)
-            except asyncio.TimeoutError:
-                logger.warning("等待消息发送超时，强制关闭")
+                await task_journal.close()
+                logger.info("任务日志已保存")
+            except Exception as e:
+                logger.warning(f"保存任务日志时出错: {str(e)}")
+        if trace_writer:
+            trace_writer.close()
+        if coordinator:
+            await coordinator.close()
         
         for i, client in enumerate(clients):
             try:
@@ -578,7 +3928,7 @@ async def main():
 if __name__ == '__main__':
     try:
         logger.info("检查 session 文件状态...")
-        for account in accounts:
+        for account in (accounts if shard_index is None else []):
             session_file = os.path.join(workdir, f'session_{account["name"]}_{account["api_id"]}.session')
             if os.path.exists(session_file):
                 logger.info(f"✓ [{account['name']}] 找到已保存的 session 文件: {session_file}")